@@ -0,0 +1,231 @@
+import json
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+#######################################################################################
+#                                        K-Means                                      #
+#######################################################################################
+
+def kmeans(x:torch.Tensor, n_clusters:int, n_iter:int=20, generator:torch.Generator=None, chunk_size:int=65536):
+    '''
+    Lloyd's k-means used to train the coarse quantizer and the product quantization codebooks.
+    Args:
+        x: tensor (n, d) of vectors
+        n_clusters: number of centroids
+        n_iter: number of iterations
+        generator: random generator used for the initialization
+        chunk_size: number of vectors assigned at once, limits the memory of the distance matrix
+    Returns:
+        centroids (n_clusters, d) and assignments (n,) of the vectors
+    '''
+    n_clusters = min(n_clusters, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:n_clusters]].clone()
+    for _ in range(n_iter):
+        assignments = assign(x, centroids, chunk_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=n_clusters)
+        # empty clusters are moved to random vectors
+        empty = counts == 0
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(x.dtype)
+        if empty.any():
+            centroids[empty] = x[torch.randint(0, x.shape[0], (int(empty.sum()),), generator=generator)]
+    return centroids, assign(x, centroids, chunk_size)
+
+def assign(x:torch.Tensor, centroids:torch.Tensor, chunk_size:int=65536):
+    '''Index of the nearest (euclidean) centroid of every vector.'''
+    centroids_norm = (centroids**2).sum(dim=1)
+    return torch.cat([(centroids_norm - 2*chunk @ centroids.T).argmin(dim=1) for chunk in x.split(chunk_size)])
+
+#######################################################################################
+#                                       IVF-PQ Index                                  #
+#######################################################################################
+
+class IVFPQIndex:
+    '''
+    Inverted file index with product quantization for maximum inner product search over article embeddings.
+    Articles are split into n_lists clusters by k-means, a query is compared only with the articles of its n_probe
+    best clusters. Within a cluster the residual of every article (embedding minus centroid) is stored as n_subvectors
+    one byte codes, and the inner product with the query is approximated with per-query lookup tables.
+    '''
+    def __init__(self, n_lists:int=256, n_subvectors:int=None, n_bits:int=8, n_probe:int=16, seed:int=42):
+        '''
+        Args:
+            n_lists: number of clusters of the coarse quantizer
+            n_subvectors: number of subvectors of the product quantizer, must divide the embedding dimension.
+                          Defaults to subvectors of 2 dimensions.
+            n_bits: bits of a code, at most 8 so codes fit into uint8
+            n_probe: default number of clusters searched for every query
+            seed: random seed of k-means
+        '''
+        assert n_bits <= 8, "codes are stored as uint8"
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.n_bits = n_bits
+        self.n_probe = n_probe
+        self.seed = seed
+
+    def build(self, embeddings, n_iter:int=20):
+        '''
+        Trains the quantizers and encodes the embeddings.
+        Args:
+            embeddings: tensor or array (n_articles, d) of article embeddings
+            n_iter: number of k-means iterations
+        Returns:
+            self
+        '''
+        embeddings = torch.as_tensor(np.asarray(embeddings, dtype=np.float32))
+        n, d = embeddings.shape
+        if self.n_subvectors is None:
+            self.n_subvectors = d // 2 if d % 2 == 0 else d
+        assert d % self.n_subvectors == 0, "n_subvectors must divide the embedding dimension"
+        generator = torch.Generator().manual_seed(self.seed)
+        # coarse quantizer
+        self.centroids, lists = kmeans(embeddings, self.n_lists, n_iter, generator)
+        self.n_lists = self.centroids.shape[0]
+        residuals = (embeddings - self.centroids[lists]).view(n, self.n_subvectors, -1)
+        # product quantizer, one codebook for every subvector
+        codebooks, codes = [], []
+        for m in range(self.n_subvectors):
+            codebook, code = kmeans(residuals[:, m].contiguous(), 2**self.n_bits, n_iter, generator)
+            codebooks.append(codebook)
+            codes.append(code)
+        n_codes = min(codebook.shape[0] for codebook in codebooks)
+        self.codebooks = torch.stack([codebook[:n_codes] for codebook in codebooks])
+        codes = torch.stack(codes, dim=1).to(torch.uint8)
+        # articles sorted by cluster, list_offsets[l]:list_offsets[l+1] are the articles of cluster l
+        order = torch.argsort(lists, stable=True)
+        self.list_ids = order
+        self.codes = codes[order]
+        self.list_offsets = torch.zeros(self.n_lists + 1, dtype=torch.int64)
+        self.list_offsets[1:] = torch.cumsum(torch.bincount(lists, minlength=self.n_lists), dim=0)
+        return self
+
+    def search(self, queries, k:int, n_probe:int=None):
+        '''
+        Approximate top-k articles by inner product for a batch of customer embeddings.
+        Args:
+            queries: tensor (n_queries, d) of customer embeddings
+            k: number of articles returned for every query
+            n_probe: number of clusters searched, defaults to the n_probe of the index
+        Returns:
+            approximate scores (n_queries, k) and article indices (n_queries, k),
+            missing results (fewer than k articles in the probed clusters) have index -1 and score -inf
+        '''
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        queries = torch.as_tensor(queries).to(torch.float32)
+        n_queries = queries.shape[0]
+        # best clusters of every query
+        coarse_scores = queries @ self.centroids.T
+        probe_scores, probes = torch.topk(coarse_scores, n_probe, dim=1)
+        # lookup tables with the inner products of the query subvectors and the codebooks
+        tables = torch.einsum("qmd,mcd->qmc", queries.view(n_queries, self.n_subvectors, -1), self.codebooks)
+        # flatten the articles of all probed clusters of all queries
+        starts = self.list_offsets[probes].flatten()
+        lengths = self.list_offsets[probes + 1].flatten() - starts
+        pair_query = torch.arange(n_queries).repeat_interleave(n_probe)
+        item_query = pair_query.repeat_interleave(lengths)
+        item_cumsum = torch.cumsum(lengths, dim=0)
+        positions = (starts - item_cumsum + lengths).repeat_interleave(lengths) + torch.arange(int(item_cumsum[-1]))
+        # approximate scores: query x centroid + sum of the lookup table entries of the codes
+        codes = self.codes[positions].to(torch.int64)
+        scores = probe_scores.flatten().repeat_interleave(lengths)
+        n_codes = self.codebooks.shape[1]
+        table_rows = item_query * n_codes
+        for m in range(self.n_subvectors):
+            scores += tables[:, m].reshape(-1)[table_rows + codes[:, m]]
+        # scatter into a padded (n_queries, max candidates) matrix for topk
+        query_lengths = lengths.view(n_queries, n_probe).sum(dim=1)
+        query_starts = torch.cumsum(query_lengths, dim=0) - query_lengths
+        columns = torch.arange(len(positions)) - query_starts[item_query]
+        width = max(int(query_lengths.max()), k)
+        padded_scores = torch.full((n_queries, width), -torch.inf)
+        padded_ids = torch.full((n_queries, width), -1, dtype=torch.int64)
+        padded_scores[item_query, columns] = scores
+        padded_ids[item_query, columns] = self.list_ids[positions]
+        top_scores, top_columns = torch.topk(padded_scores, k, dim=1)
+        return top_scores, padded_ids.gather(1, top_columns)
+
+    def search_bytes(self, n_probe:int=None):
+        '''
+        Approximate memory used by search for one query. Search scores every article of the probed clusters, so the memory
+        grows with the size of the n_probe largest clusters (codes, positions and scores of every article) and not with k.
+        '''
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        sizes = self.list_offsets[1:] - self.list_offsets[:-1]
+        n_items = int(torch.topk(sizes, n_probe).values.sum())
+        # int64 codes of every subvector and about eight int64/float32 temporaries per article
+        return n_items * (8*self.n_subvectors + 64) + self.n_subvectors * self.codebooks.shape[1] * 4
+
+    def save(self, path:str):
+        '''Saves the index into a .npz file.'''
+        params = {"n_lists": self.n_lists, "n_subvectors": self.n_subvectors, "n_bits": self.n_bits,
+                  "n_probe": self.n_probe, "seed": self.seed}
+        np.savez(path, params=json.dumps(params), centroids=self.centroids.numpy(), codebooks=self.codebooks.numpy(),
+                 codes=self.codes.numpy(), list_ids=self.list_ids.numpy(), list_offsets=self.list_offsets.numpy())
+
+    @classmethod
+    def load(cls, path:str):
+        '''Loads the index saved by save.'''
+        arrays = np.load(path)
+        index = cls(**json.loads(str(arrays["params"])))
+        for name in ["centroids", "codebooks", "codes", "list_ids", "list_offsets"]:
+            setattr(index, name, torch.from_numpy(arrays[name]))
+        return index
+
+    def __len__(self):
+        return len(self.list_ids)
+
+#######################################################################################
+#                                        Evaluation                                   #
+#######################################################################################
+
+def brute_force_search(queries, embeddings, k:int, batch_size:int=1000):
+    '''Exact top-k articles by inner product, used as the reference of the index.'''
+    queries = torch.as_tensor(queries).to(torch.float32)
+    embeddings = torch.as_tensor(embeddings).to(torch.float32)
+    results = [torch.topk(batch @ embeddings.T, k, dim=1) for batch in queries.split(batch_size)]
+    return torch.cat([scores for scores, _ in results]), torch.cat([indices for _, indices in results])
+
+def candidate_scores(queries, embeddings, candidates):
+    '''Exact inner products of the queries with their candidate articles, padded candidates (-1) get -inf.'''
+    scores = (queries.unsqueeze(1) * embeddings[candidates.clamp(min=0)]).sum(dim=2)
+    return scores.masked_fill(candidates < 0, -torch.inf)
+
+def recall_report(index:IVFPQIndex, queries, embeddings, k:int=12, n_probes=(1, 4, 16, 64), rerank:int=None, batch_size:int=1000):
+    '''
+    Compares the index with brute force search.
+    Args:
+        index: built IVFPQIndex
+        queries: customer embeddings (n_queries, d)
+        embeddings: article embeddings (n_articles, d) used to build the index
+        k: number of retrieved articles
+        n_probes: numbers of probed clusters to evaluate
+        rerank: if given, rerank candidates are retrieved from the index and reranked with the exact scores
+        batch_size: number of queries searched at once
+    Returns:
+        dataframe with recall@k (share of the exact top-k found by the index) and query time for every n_probe
+    '''
+    queries = torch.as_tensor(queries).to(torch.float32)
+    embeddings = torch.as_tensor(embeddings).to(torch.float32)
+    start = time.perf_counter()
+    _, exact = brute_force_search(queries, embeddings, k, batch_size)
+    brute_force_seconds = time.perf_counter() - start
+
+    results = []
+    for n_probe in n_probes:
+        start = time.perf_counter()
+        found = []
+        for batch in queries.split(batch_size):
+            _, candidates = index.search(batch, rerank or k, n_probe)
+            if rerank:
+                top_candidates = torch.topk(candidate_scores(batch, embeddings, candidates), k, dim=1).indices
+                candidates = candidates.gather(1, top_candidates)
+            found.append(candidates)
+        seconds = time.perf_counter() - start
+        found = torch.cat(found)
+        hits = (found.unsqueeze(2) == exact.unsqueeze(1)).any(dim=1).sum().item()
+        results.append({"n_probe": n_probe, f"recall@{k}": hits / exact.numel(), "seconds": seconds,
+                        "brute_force_seconds": brute_force_seconds})
+    return pd.DataFrame(results)
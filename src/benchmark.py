@@ -0,0 +1,388 @@
+import time
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset, BatchSampler
+from scipy.sparse import csr_matrix
+from data_reader import CategoricalEncoder, MF_batch_collate, load_data_mf, SparseDataset, sparse_batch_collate
+from runtime import available_cores, get_runtime
+from recommenders import top_k_articles_parallel
+from model import TwoTowerFinal, InBatchSoftmaxLoss, ArticleTowerEmbedded, MLP1, SampledSoftmaxLoss
+from helper import SampledSoftmaxBatches
+
+def timeit(function, repeat=3):
+    '''
+    Measures the best wall time of the function.
+    Args:
+        function: function without arguments to be measured
+        repeat: number of repetitions
+    Returns:
+        best time in seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+#######################################################################################
+#                                   Data Preprocessing                                #
+#######################################################################################
+
+def benchmark_encoding(n_rows=1_000_000, n_categories=100_000, repeat=3, seed=42):
+    '''
+    Compares the dictionary based encoding (Series.apply with dict lookups) with CategoricalEncoder.
+    Uses customer_id like hashes as the original values.
+    Args:
+        n_rows: number of transactions to encode
+        n_categories: number of unique values
+        repeat: number of repetitions
+        seed: random seed
+    Returns:
+        dataframe with timings of both methods for fitting and encoding new transactions
+    '''
+    rng = np.random.default_rng(seed)
+    categories = np.array([f"{value:064x}" for value in rng.integers(0, 2**63, n_categories)], dtype=object)
+    values = pd.Series(categories[rng.integers(0, n_categories, n_rows)])
+
+    def dict_fit():
+        names = values.unique()
+        encoders = np.arange(len(names))
+        encodings = dict(zip(names, encoders))
+        return values.apply(lambda x: encodings[x])
+
+    def encoder_fit():
+        return CategoricalEncoder.fit_transform(values)
+
+    dict_codes = dict_fit()
+    encoder_codes, encoder = encoder_fit()
+    assert np.array_equal(dict_codes.to_numpy(), encoder_codes)
+    encodings = encoder.encoding
+
+    results = pd.DataFrame({
+        "stage": ["fit", "transform"],
+        "dict_seconds": [timeit(dict_fit, repeat), timeit(lambda: values.apply(lambda x: encodings[x]), repeat)],
+        "encoder_seconds": [timeit(encoder_fit, repeat), timeit(lambda: encoder.transform(values), repeat)],
+    })
+    results["speedup"] = results["dict_seconds"] / results["encoder_seconds"]
+    return results
+
+#######################################################################################
+#                                      Data Loaders                                   #
+#######################################################################################
+
+class RowDatasetMF(Dataset):
+    '''Previous implementation of DatasetMF with pandas lookups for every row, used as a baseline.'''
+    def __init__(self, trans:pd.DataFrame):
+        self.transactions = trans
+
+    def __getitem__(self, index:int):
+        return (self.transactions["article_id"][index], 
+                self.transactions["customer_id"][index], 
+                self.transactions["purchased"][index])
+
+    def __len__(self):
+        return self.transactions.shape[0]
+
+def benchmark_mf_loader(n_rows=200_000, batch_size=1000, repeat=3, seed=42):
+    '''
+    Compares the throughput of the row based DatasetMF with the batch indexed DatasetMF used by load_data_mf.
+    Args:
+        n_rows: number of transactions
+        batch_size: batch size for the data loader
+        repeat: number of repetitions
+        seed: random seed
+    Returns:
+        dataframe with the time of a full pass over the data and rows per second for both loaders
+    '''
+    rng = np.random.default_rng(seed)
+    trans = pd.DataFrame({"customer_id": rng.integers(0, 1_000_000, n_rows), 
+                          "article_id": rng.integers(0, 100_000, n_rows), 
+                          "purchased": rng.integers(0, 2, n_rows).astype(float)})
+    row_loader = DataLoader(RowDatasetMF(trans), batch_size=batch_size, collate_fn=MF_batch_collate)
+    batch_loader, _, _ = load_data_mf(trans, batch_size=batch_size)
+
+    def full_pass(loader):
+        for _ in loader:
+            pass
+
+    results = pd.DataFrame({
+        "loader": ["row", "batch"],
+        "seconds": [timeit(lambda: full_pass(row_loader), repeat), timeit(lambda: full_pass(batch_loader), repeat)],
+    })
+    # batch loader iterates only over 90% of rows, the rest is the validation set
+    results["rows_per_second"] = [n_rows, len(batch_loader.dataset)] / results["seconds"]
+    return results
+
+def benchmark_sparse_loader(n_customers=100_000, n_articles=105_542, basket_size=20, batch_size=1000, repeat=3, seed=42):
+    '''
+    Compares the collate based loading of SparseDataset rows (vstack of csr rows and conversion to coo tensors)
+    with the batch indexed SparseDataset returning csr tensors, used by load_data.
+    Args:
+        n_customers: number of customers
+        n_articles: number of articles
+        basket_size: number of purchased articles of a customer
+        batch_size: batch size for the data loader
+        repeat: number of repetitions
+        seed: random seed
+    Returns:
+        dataframe with the time of a full pass over the data and rows per second for both loaders
+    '''
+    rng = np.random.default_rng(seed)
+    rows = np.repeat(np.arange(n_customers), basket_size)
+    def baskets():
+        matrix = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, rng.integers(0, n_articles, len(rows)))), shape=(n_customers, n_articles))
+        matrix.sum_duplicates()
+        return matrix
+    dataset = SparseDataset(baskets(), baskets())
+    # shuffled rows like the split of load_data
+    order = rng.permutation(n_customers).tolist()
+    row_loader = DataLoader(Subset(dataset, order), batch_size=batch_size, collate_fn=sparse_batch_collate)
+    batch_loader = DataLoader(dataset, batch_size=None, sampler=BatchSampler(order, batch_size=batch_size, drop_last=False))
+
+    def full_pass(loader):
+        for _ in loader:
+            pass
+
+    results = pd.DataFrame({
+        "loader": ["collate", "csr_batch"],
+        "seconds": [timeit(lambda: full_pass(row_loader), repeat), timeit(lambda: full_pass(batch_loader), repeat)],
+    })
+    results["rows_per_second"] = n_customers / results["seconds"]
+    return results
+
+#######################################################################################
+#                                         Models                                      #
+#######################################################################################
+
+class DiagTwoTowerFinal(TwoTowerFinal):
+    '''Previous scoring of TwoTowerFinal through the diagonal of the full B x B matrix, used as a baseline.'''
+    def forward(self, customer_features, article_features):
+        customer_features = self.CustomerTower(customer_features)
+        article_features = self.ArticleTower(article_features)
+        return torch.sigmoid(torch.matmul(customer_features,article_features.T).diag())
+
+def benchmark_scoring(batch_sizes=(1024, 4096, 16384), input_article_dim=100, input_customer_dim=50, output_dim=10, repeat=5, seed=42):
+    '''
+    Compares the training step time of TwoTowerFinal with diagonal scoring, row-wise dot product scoring 
+    and in-batch negatives with InBatchSoftmaxLoss for different batch sizes.
+    Args:
+        batch_sizes: list of batch sizes
+        input_article_dim: number of articles features
+        input_customer_dim: number of customers features
+        output_dim: dimension of the embeddings
+        repeat: number of repetitions
+        seed: random seed
+    Returns:
+        dataframe with the step time in milliseconds of every scoring for every batch size
+    '''
+    torch.manual_seed(seed)
+    models = {"diag": (DiagTwoTowerFinal(input_article_dim, input_customer_dim, output_dim), torch.nn.BCELoss()),
+              "dot": (TwoTowerFinal(input_article_dim, input_customer_dim, output_dim), torch.nn.BCELoss()),
+              "in_batch": (TwoTowerFinal(input_article_dim, input_customer_dim, output_dim, in_batch_negatives=True), InBatchSoftmaxLoss())}
+
+    results = []
+    for batch_size in batch_sizes:
+        customers = torch.randn(batch_size, input_customer_dim)
+        articles = torch.randn(batch_size, input_article_dim)
+        targets = torch.randint(0, 2, (batch_size,)).float()
+        row = {"batch_size": batch_size}
+        for name, (model, criterion) in models.items():
+            optimizer = torch.optim.Adam(model.parameters())
+            def step():
+                optimizer.zero_grad()
+                criterion(model(customers, articles), targets).backward()
+                optimizer.step()
+            row[f"{name}_ms"] = 1000 * timeit(step, repeat)
+        results.append(row)
+    return pd.DataFrame(results)
+
+class LoopArticleTowerEmbedded(torch.nn.Module):
+    '''Previous ArticleTowerEmbedded with one embedding layer per column, used as a baseline.'''
+    def __init__(self, article_cat_dim, embedding_dim=3, output_dim=3):
+        super(LoopArticleTowerEmbedded, self).__init__()
+        self.embedding_layers = torch.nn.ModuleList([torch.nn.Embedding(num_categories, embedding_dim) for num_categories in article_cat_dim])
+        self.fc1 = torch.nn.Linear(embedding_dim * len(article_cat_dim), output_dim)
+
+    def forward(self, x):
+        embedded_features = [embedding_layer(x[:,i]) for i, embedding_layer in enumerate(self.embedding_layers)]
+        return torch.relu(self.fc1(torch.cat(embedded_features, dim=-1)))
+
+def benchmark_article_embedding(article_cat_dim=(132, 131, 19, 29, 50, 30, 9, 250, 53, 10, 21, 11, 45, 4, 1000), embedding_dim=5, 
+                                output_dim=10, batch_size=4096, repeat=10, seed=42):
+    '''
+    Compares the training step and inference time of ArticleTowerEmbedded with the per-column embedding layers
+    and the size of the float32 and int8 embedding tables.
+    Args:
+        article_cat_dim: number of categories of every article column
+        embedding_dim: dimension of the embeddings of every column
+        output_dim: dimension of the article embeddings
+        batch_size: number of articles in a batch
+        repeat: number of repetitions
+        seed: random seed
+    Returns:
+        dataframe with the step and inference time in milliseconds and the size of the table in bytes
+    '''
+    torch.manual_seed(seed)
+    x = torch.stack([torch.randint(0, dim, (batch_size,)) for dim in article_cat_dim], dim=1)
+    loop = LoopArticleTowerEmbedded(article_cat_dim, embedding_dim, output_dim)
+    fused = ArticleTowerEmbedded(article_cat_dim, embedding_dim, output_dim)
+    fused.load_state_dict(loop.state_dict())
+    quantized = ArticleTowerEmbedded(article_cat_dim, embedding_dim, output_dim)
+    quantized.load_state_dict(loop.state_dict())
+    quantized.quantize()
+
+    def step(model):
+        model.zero_grad()
+        model(x).sum().backward()
+
+    def inference(model):
+        with torch.no_grad():
+            model(x)
+
+    def table_bytes(model):
+        return sum(buffer.numel()*buffer.element_size() for name, buffer in model.state_dict().items() if not name.startswith("fc1"))
+
+    return pd.DataFrame({
+        "model": ["loop", "fused", "fused_int8"],
+        "step_ms": [1000*timeit(lambda: step(loop), repeat), 1000*timeit(lambda: step(fused), repeat), np.nan],
+        "inference_ms": [1000*timeit(lambda: inference(model), repeat) for model in [loop, fused, quantized]],
+        "table_bytes": [table_bytes(model) for model in [loop, fused, quantized]],
+    })
+
+def benchmark_sparse_input(n_articles=105_542, batch_size=1000, basket_size=20, repeat=3, seed=42):
+    '''
+    Compares the training step of MLP1 with the sparse baskets from sparse_batch_collate and with the same baskets
+    converted to dense inputs, as the training functions did before.
+    Args:
+        n_articles: number of articles (input and output dimension)
+        batch_size: number of customers in a batch
+        basket_size: average number of purchased articles of a customer
+        repeat: number of repetitions
+        seed: random seed
+    Returns:
+        dataframe with the step time in milliseconds and the size of the input in bytes
+    '''
+    torch.manual_seed(seed)
+    nnz = batch_size*basket_size
+    indices = torch.stack([torch.randint(0, batch_size, (nnz,)), torch.randint(0, n_articles, (nnz,))])
+    sparse = torch.sparse_coo_tensor(indices, torch.ones(nnz), (batch_size, n_articles)).coalesce()
+    model = MLP1(n_articles, n_articles)
+
+    def step(x):
+        model.zero_grad()
+        model(x).sum().backward()
+
+    return pd.DataFrame({
+        "input": ["dense", "sparse"],
+        "step_ms": [1000*timeit(lambda: step(sparse.to_dense()), repeat), 1000*timeit(lambda: step(sparse), repeat)],
+        "input_bytes": [batch_size*n_articles*4, sparse.indices().nbytes + sparse.values().nbytes],
+    })
+
+def benchmark_sampled_softmax(n_articles=105_542, batch_size=1000, basket_size=20, negatives=(1000, 10_000), repeat=3, seed=42):
+    '''
+    Compares the training step of MLP1 scoring the whole catalog with BCELoss and scoring only the purchased articles
+    and sampled negatives with SampledSoftmaxLoss.
+    Args:
+        n_articles: number of articles (input and output dimension)
+        batch_size: number of customers in a batch
+        basket_size: average number of purchased articles of a customer
+        negatives: numbers of sampled negatives
+        repeat: number of repetitions
+        seed: random seed
+    Returns:
+        dataframe with the step time in milliseconds and the number of scored articles
+    '''
+    torch.manual_seed(seed)
+    nnz = batch_size*basket_size
+    def basket():
+        indices = torch.stack([torch.randint(0, batch_size, (nnz,)), torch.randint(0, n_articles, (nnz,))]).unique(dim=1)
+        return torch.sparse_coo_tensor(indices, torch.ones(indices.shape[1]), (batch_size, n_articles)).coalesce()
+    inputs, targets = basket(), basket()
+    model = MLP1(n_articles, n_articles)
+    runtime = get_runtime("cpu")
+
+    def full_step():
+        model.zero_grad()
+        torch.nn.functional.binary_cross_entropy(model(inputs), targets.to_dense()).backward()
+
+    def sampled_step(batches):
+        model.zero_grad()
+        (x, articles), (labels, log_q) = batches((inputs, targets), runtime)
+        SampledSoftmaxLoss()(model(x, articles), labels, log_q).backward()
+
+    results = [{"mode": "full", "scored_articles": n_articles, "step_ms": 1000*timeit(full_step, repeat)}]
+    for n_negatives in negatives:
+        batches = SampledSoftmaxBatches(n_articles, n_negatives)
+        scored = len(batches((inputs, targets), runtime)[0][1])
+        results.append({"mode": f"sampled_{n_negatives}", "scored_articles": scored, "step_ms": 1000*timeit(lambda: sampled_step(batches), repeat)})
+    return pd.DataFrame(results)
+
+#######################################################################################
+#                                        Runtime                                      #
+#######################################################################################
+
+def benchmark_threads(n_customers=10_000, n_articles=100_000, embedding_dim=64, threads=None, repeat=3, seed=42):
+    '''
+    Measures the scoring of customer embeddings against all article embeddings on cpu for different numbers of threads.
+    Args:
+        n_customers: number of customer embeddings
+        n_articles: number of article embeddings
+        embedding_dim: dimension of the embeddings
+        threads: list of thread counts, defaults to powers of two up to the number of available cores
+        repeat: number of repetitions
+        seed: random seed
+    Returns:
+        dataframe with the time of the scoring for every thread count
+    '''
+    if threads is None:
+        threads = [2**i for i in range(int(np.log2(available_cores())) + 1)]
+    generator = torch.Generator().manual_seed(seed)
+    customers = torch.randn(n_customers, embedding_dim, generator=generator)
+    articles = torch.randn(n_articles, embedding_dim, generator=generator)
+
+    # only the number of threads is changed, the default runtime and the previous thread count are kept for the caller
+    previous_threads = torch.get_num_threads()
+    seconds = []
+    try:
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            seconds.append(timeit(lambda: torch.topk(customers @ articles.T, k=12, dim=1), repeat))
+    finally:
+        torch.set_num_threads(previous_threads)
+    return pd.DataFrame({"threads": threads, "seconds": seconds})
+
+def benchmark_parallel_recommendations(n_customers=200_000, n_articles=100_000, embedding_dim=10, top_k=12, workers=None, seed=42):
+    '''
+    Measures the throughput of top_k_articles_parallel for different numbers of worker processes.
+    Args:
+        n_customers: number of customer embeddings
+        n_articles: number of article embeddings
+        embedding_dim: dimension of the embeddings
+        top_k: number of recommendations
+        workers: list of numbers of processes, defaults to powers of two up to the number of available cores
+        seed: random seed
+    Returns:
+        dataframe with the time and customers per second for every number of processes
+    '''
+    if workers is None:
+        workers = [2**i for i in range(int(np.log2(available_cores())) + 1)]
+    generator = torch.Generator().manual_seed(seed)
+    customers = torch.randn(n_customers, embedding_dim, generator=generator)
+    articles = torch.randn(n_articles, embedding_dim, generator=generator)
+    seconds = [timeit(lambda: top_k_articles_parallel(customers, articles, top_k, num_workers=num_workers), repeat=1) for num_workers in workers]
+    results = pd.DataFrame({"workers": workers, "seconds": seconds})
+    results["customers_per_second"] = n_customers / results["seconds"]
+    return results
+
+if __name__ == "__main__":
+    print(benchmark_encoding())
+    print(benchmark_mf_loader())
+    print(benchmark_sparse_loader())
+    print(benchmark_scoring())
+    print(benchmark_article_embedding())
+    print(benchmark_sparse_input())
+    print(benchmark_sampled_softmax())
+    print(benchmark_threads())
+    print(benchmark_parallel_recommendations())
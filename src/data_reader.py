@@ -1,31 +1,43 @@
 import numpy as np
 import pandas as pd
 import os
-from torch.utils.data import DataLoader, Dataset, random_split
+from torch.utils.data import (DataLoader, 
+                              Dataset, 
+                              IterableDataset, 
+                              BatchSampler, 
+                              SequentialSampler, 
+                              get_worker_info)
 import torch
 from typing import Union
 from scipy.sparse import (random, 
                           coo_matrix,
                           csr_matrix, 
                           csr_array,
+                          diags,
                           vstack)
 from tqdm import tqdm
 import pickle
+import io
+import json
+import hashlib
 from scipy.sparse import csr_matrix
 from sklearn.model_selection import train_test_split
 from sklearn import preprocessing 
 from sklearn.cluster import KMeans
+from storage import interaction_keys, csr_interaction_keys, contains_keys, downcast_column, _save_table, _load_table, save_columns
 
 
 os.chdir("/Users/karol/Desktop/Antwerp/ai_project/")
 ARTICLES_PATH = "/Users/karol/Desktop/Antwerp/ai_project/data/articles.csv"
 CUSTOMER_PATH = "/Users/karol/Desktop/Antwerp/ai_project/data/customers.csv"
 TRANSACTION_PATH = "/Users/karol/Desktop/Antwerp/ai_project/data/transactions_train.csv"
+CACHE_DIR = "data/preprocessed/cache"
+CACHE_VERSION = 2
 
 #######################################################################################
 #                                 Data Transformations                                #
 #######################################################################################
-def data_preprocessing(feature_generation=False, return_encodings=False, save=False):
+def data_preprocessing(feature_generation=False, return_encodings=False, save=False, use_cache=False, save_csv=False, cache_dir=CACHE_DIR, chunk_size=None):
     '''
     Responsible for preprocessing the data. It includes opreations such as article encoding or customers encodings. Also handles missing data. 
     There is also function which does some basic feature engineering based on the feature_engineering.ipynb file but ultimately it is not used.
@@ -33,7 +45,12 @@ def data_preprocessing(feature_generation=False, return_encodings=False, save=Fa
     Args:
         feature_generation: boolean indicating whether to perform feature engineering or not
         return_encodings: boolean indicating whether to return the encodings or not
-        save: boolean indicating whether to save preprocessed dataframes and encodings
+        save: boolean indicating whether to save preprocessed dataframes and encodings to the binary cache
+        use_cache: boolean indicating whether to load the binary cache instead of parsing the csv files when it is up to date
+        save_csv: boolean indicating whether to additionally save the legacy csv and pickle files
+        cache_dir: directory of the binary cache
+        chunk_size: if given, transactions are read, encoded and written to the binary cache in chunks of that many rows,
+                    which bounds the memory usage (implies save, returned transactions are memory mapped from the cache)
     Returns:
         transactions: preprocessed transactions dataframe
         customers: preprocessed customers dataframe
@@ -43,10 +60,16 @@ def data_preprocessing(feature_generation=False, return_encodings=False, save=Fa
         article_decodings: dictionary of article decodings
         customer_decodings: dictionary of customer decodings
     '''
+    if use_cache and cache_is_valid(cache_dir, feature_generation):
+        return load_preprocessed(cache_dir, return_encodings=return_encodings)
+    if chunk_size is not None and feature_generation:
+        raise ValueError("feature_generation requires all transactions in memory and cannot be used with chunk_size")
+
     customers = pd.read_csv(CUSTOMER_PATH)
-    transactions = pd.read_csv(TRANSACTION_PATH)
+    if chunk_size is None:
+        transactions = pd.read_csv(TRANSACTION_PATH)
+        transactions["t_dat"] = pd.to_datetime(transactions["t_dat"])
     articles = pd.read_csv(ARTICLES_PATH)
-    transactions["t_dat"] = pd.to_datetime(transactions["t_dat"])
     
 
     # ARTICLE PREPROCESSING
@@ -54,14 +77,9 @@ def data_preprocessing(feature_generation=False, return_encodings=False, save=Fa
     articles = articles[['article_id'] + list(articles.select_dtypes(include=['object']).columns)]
     articles = articles.drop(columns=["detail_desc","index_code"])
 
-    article_encodings = {}
-    article_decodings = {}
+    article_encoders = {}
     for column in articles.columns:
-        names = articles[column].unique()
-        encoders = np.arange(len(names))
-        article_encodings[column] = dict(zip(names, encoders))
-        article_decodings[column] = dict(zip(encoders, names))
-        articles[column] = articles[column].apply(lambda x: article_encodings[column][x])
+        articles[column], article_encoders[column] = CategoricalEncoder.fit_transform(articles[column])
     # article feature selection
     cols_to_delete = ["prod_name","product_group_name","colour_group_name","perceived_colour_value_name","perceived_colour_value_name","index_group_name"]
     articles = articles.drop(columns=cols_to_delete)
@@ -76,26 +94,19 @@ def data_preprocessing(feature_generation=False, return_encodings=False, save=Fa
     # customer encodings
     customer_cols = ["customer_id","club_member_status","fashion_news_frequency","postal_code"]
     customers = customers.fillna(-1)
-    customer_encodings = {}
-    customer_decodings = {}
-    for column in customers[customer_cols]:
-        names = customers[column].unique()
-        if -1 in names:
-            names = names[names != -1]
-            encoders = np.arange(len(names))
-            customer_encodings[column] = dict(zip(names, encoders))
-            customer_encodings[column][-1] = -1
-        else:
-            encoders = np.arange(len(names))
-            customer_encodings[column] = dict(zip(names, encoders))
-        customer_decodings[column] = dict(zip(encoders, names))
-        
-        customers[column] = customers[column].apply(lambda x: customer_encodings[column][x])
+    customer_encoders = {}
+    for column in customer_cols:
+        # missing values are encoded as -1
+        customers[column], customer_encoders[column] = CategoricalEncoder.fit_transform(customers[column], missing=-1)
     
     # TRANSACTIONS PREPROCESSING
-    transactions["t_dat"] = pd.to_datetime(transactions["t_dat"])
-    transactions["customer_id"] = transactions["customer_id"].apply(lambda x: customer_encodings["customer_id"][x])
-    transactions["article_id"] = transactions["article_id"].apply(lambda x: article_encodings["article_id"][x])
+    if chunk_size is not None:
+        transactions = stream_transactions(article_encoders["article_id"], customer_encoders["customer_id"], 
+                                           cache_dir=cache_dir, chunk_size=chunk_size)
+    else:
+        transactions["t_dat"] = pd.to_datetime(transactions["t_dat"])
+        transactions["customer_id"] = customer_encoders["customer_id"].transform(transactions["customer_id"])
+        transactions["article_id"] = article_encoders["article_id"].transform(transactions["article_id"])
 
     # FEATURE GENERATION
     if feature_generation:
@@ -120,7 +131,18 @@ def data_preprocessing(feature_generation=False, return_encodings=False, save=Fa
         transactions["price_diff"] = transactions["price_diff"].apply(lambda x: 1 if x < 0 else 0)
         transactions = transactions.sort_index()
     
-    if save:
+    if save or chunk_size is not None:
+        save_preprocessed(transactions, articles, customers, article_encoders, customer_encoders, 
+                          cache_dir=cache_dir, feature_generation=feature_generation, 
+                          transactions_saved=chunk_size is not None)
+
+    # dictionaries are only built when needed, it is slow for more than 1M customers
+    if not (save_csv or return_encodings):
+        return transactions, articles, customers
+
+    article_encodings, article_decodings = encoders_to_dicts(article_encoders)
+    customer_encodings, customer_decodings = encoders_to_dicts(customer_encoders)
+    if save_csv:
         transactions.to_csv("data/preprocessed/transactions.csv", index=False)
         articles.to_csv("data/preprocessed/articles.csv", index=False)
         customers.to_csv("data/preprocessed/customers.csv", index=False)
@@ -143,31 +165,168 @@ def data_preprocessing(feature_generation=False, return_encodings=False, save=Fa
     else:
         return transactions, articles, customers
 
+class CategoricalEncoder:
+    '''
+    Array backed encoder of a categorical column. Codes are assigned in order of the first appearance, 
+    which gives the same codes as the dictionary encodings used before.
+    Lookup tables:
+        categories: np.array where categories[code] is the original value (code -> id)
+        index: pd.Index over categories, a hash table used to vectorize the id -> code lookup
+    '''
+    def __init__(self, categories, missing=None):
+        self.categories = np.asarray(categories)
+        self.index = pd.Index(self.categories)
+        self.missing = missing
+
+    @classmethod
+    def fit_transform(cls, values, missing=None):
+        '''
+        Creates the encoder from the values and encodes them in a single pd.factorize pass.
+        Args:
+            values: pandas series or np.array with the original values
+            missing: value representing missing data, it gets the code -1 and is not part of the categories
+        Returns:
+            codes: np.array of codes
+            encoder: CategoricalEncoder
+        '''
+        values = pd.Series(values)
+        if missing is None:
+            codes, categories = pd.factorize(values, use_na_sentinel=False)
+            return codes, cls(categories, missing)
+        is_missing = (values == missing).to_numpy()
+        codes = np.full(len(values), -1, dtype=np.int64)
+        codes[~is_missing], categories = pd.factorize(values[~is_missing], use_na_sentinel=False)
+        return codes, cls(categories, missing if is_missing.any() else None)
+
+    def transform(self, values):
+        '''
+        Encodes the values with the hash table lookup. Raises KeyError for values which are not part of the encoder.
+        Args:
+            values: pandas series or np.array with the original values
+        Returns:
+            np.array of codes
+        '''
+        codes = self.index.get_indexer(values)
+        unknown = codes == -1
+        if self.missing is not None:
+            unknown &= np.asarray(values != self.missing)
+        if unknown.any():
+            raise KeyError(f"{unknown.sum()} values are not part of the encoder, e.g. {np.asarray(values)[unknown][0]}")
+        return codes
+
+    def extend(self, values):
+        '''
+        Adds values which are not yet part of the encoder. They get the next free codes, existing codes are never renumbered.
+        Args:
+            values: pandas series or np.array with the original values
+        Returns:
+            number of added categories
+        '''
+        values = pd.Series(values)
+        unknown = self.index.get_indexer(values) == -1
+        if self.missing is not None:
+            unknown &= (values != self.missing).to_numpy()
+        new_categories = pd.unique(values[unknown])
+        if len(new_categories) > 0:
+            self.categories = np.concatenate([self.categories, new_categories])
+            self.index = pd.Index(self.categories)
+        return len(new_categories)
+
+    def inverse_transform(self, codes):
+        '''Decodes the codes with the code -> id array.'''
+        return self.categories[np.asarray(codes)]
+
+    def __len__(self):
+        return len(self.categories)
+
+    @property
+    def encoding(self):
+        '''Dictionary encoding (original value -> code) used by the notebooks.'''
+        encoding = dict(zip(self.categories.tolist(), range(len(self.categories))))
+        if self.missing is not None:
+            encoding[self.missing] = -1
+        return encoding
+
+    @property
+    def decoding(self):
+        '''Dictionary decoding (code -> original value) used by the notebooks.'''
+        return dict(zip(range(len(self.categories)), self.categories.tolist()))
+
+def encoders_to_dicts(encoders):
+    '''
+    Converts dictionary of CategoricalEncoders to the dictionaries of encodings and decodings.
+    Args:
+        encoders: dictionary of CategoricalEncoders for each column
+    Returns:
+        encodings: dictionary of encodings
+        decodings: dictionary of decodings
+    '''
+    encodings = {column: encoder.encoding for column, encoder in encoders.items()}
+    decodings = {column: encoder.decoding for column, encoder in encoders.items()}
+    return encodings, decodings
+
+def last_purchase_mask(transactions):
+    '''
+    Marks the transactions from the last purchase date of their customer. The last date of every customer is found
+    in a single scan over the encoded customer ids (np.maximum.at), without the groupby and merge of the whole dataframe.
+    Args:
+        transactions: transactions dataframe with encoded customer_id
+    Returns:
+        boolean np.array, True for the transactions from the last purchase date of the customer
+    '''
+    customers = transactions['customer_id'].to_numpy()
+    dates = transactions['t_dat'].to_numpy().astype("datetime64[ns]").view(np.int64)
+    last_dates = np.full(np.max(customers)+1 if len(customers) else 0, np.iinfo(np.int64).min)
+    np.maximum.at(last_dates, customers, dates)
+    return last_dates[customers] == dates
+
+def customer_baskets(transactions, train_test=True, customer_size=None):
+    '''
+    Creates customer baskets as offset arrays: the articles of customer c are articles[indptr[c]:indptr[c+1]],
+    in the order of the transactions. Same layout as the rows of a csr matrix, without python lists per customer.
+    Args:
+        transactions: transactions dataframe
+        train_test: boolean indicating whether to split the baskets into train and test (last purchase date) or not
+        customer_size: number of customers, defaults to the largest customer_id + 1, smaller values raise a ValueError
+    Returns:
+        (indptr, articles): baskets of all transactions, or
+        (indptr, articles), (indptr, articles): train and test baskets if train_test
+    '''
+    customers = transactions['customer_id'].to_numpy()
+    articles = transactions['article_id'].to_numpy()
+    n_customers = np.max(customers)+1 if len(customers) else 0
+    if customer_size is None:
+        customer_size = n_customers
+    elif customer_size < n_customers:
+        raise ValueError(f"customer_size {customer_size} is smaller than the largest customer_id + 1 ({n_customers})")
+    def baskets(mask=None):
+        selected_customers = customers if mask is None else customers[mask]
+        selected_articles = articles if mask is None else articles[mask]
+        order = np.argsort(selected_customers, kind="stable")
+        indptr = np.zeros(customer_size+1, dtype=np.int64)
+        np.cumsum(np.bincount(selected_customers, minlength=customer_size), out=indptr[1:])
+        return indptr, selected_articles[order]
+    if train_test:
+        last = last_purchase_mask(transactions)
+        return baskets(~last), baskets(last)
+    return baskets()
+
 def customer_buckets(transactions, train_test=True):
     '''
-    Responsible for creating customer buckets.
+    Responsible for creating customer buckets. Built from customer_baskets, which should be preferred for large datasets.
     Args:
         transactions: transactions dataframe
         train_test: boolean indicating whether to split the dataset into train and test or not
     Returns:
         customer_buckets: dictionary of customers buckets
     '''
-    # last purchase for customer
+    def to_dict(indptr, articles):
+        customers = np.flatnonzero(np.diff(indptr))
+        return {customer: articles[indptr[customer]:indptr[customer+1]].tolist() for customer in customers.tolist()}
     if train_test:
-        customer_last_purchase = transactions.groupby('customer_id')['t_dat'].max()
-        merged = transactions.merge(customer_last_purchase, on='customer_id', suffixes=('', '_last_purchase'))
-        # filter train and test dataset
-        train_transactions = merged[merged['t_dat'] != merged['t_dat_last_purchase']]
-        test_transactions = merged[merged['t_dat'] == merged['t_dat_last_purchase']]
-
-        # get baskets
-        train_buckets = train_transactions.groupby("customer_id")["article_id"].apply(list).to_dict()
-        test_buckets = test_transactions.groupby("customer_id")["article_id"].apply(list).to_dict()
-
-        return train_buckets, test_buckets
-    else:
-        customer_buckets = transactions.groupby("customer_id")["article_id"].apply(list).to_dict()
-        return customer_buckets
+        train_baskets, test_baskets = customer_baskets(transactions, train_test=True)
+        return to_dict(*train_baskets), to_dict(*test_baskets)
+    return to_dict(*customer_baskets(transactions, train_test=False))
 
 def split_transactions(transactions):
     '''
@@ -178,100 +337,223 @@ def split_transactions(transactions):
         x_transactions: train transactions dataframe
         y_transactions: validation transactions dataframe
     '''
-    customer_last_purchase = transactions.groupby('customer_id')['t_dat'].max()
-    merged = transactions.merge(customer_last_purchase, on='customer_id', suffixes=('', '_last_purchase'))
-    # filter train and test dataset
-    x_transactions = merged[merged['t_dat'] != merged['t_dat_last_purchase']]
-    y_transactions = merged[merged['t_dat'] == merged['t_dat_last_purchase']]
-    return x_transactions, y_transactions
+    last = last_purchase_mask(transactions)
+    return transactions[~last], transactions[last]
 
-def matrix_representation(transactions, train_test=True):
+def catalog_size(cache_dir=CACHE_DIR):
+    '''
+    Number of encoded articles, read from the article encoder of the cache (which grows with append_transactions).
+    Falls back to the number of articles in articles.csv if there is no cache, and to None if neither exists.
+    '''
+    path = os.path.join(cache_dir, "encodings", "articles", "article_id.npy")
+    if os.path.exists(os.path.join(cache_dir, "meta.json")) and os.path.exists(path):
+        return np.load(path, mmap_mode="r", allow_pickle=True).shape[0]
+    if os.path.exists(ARTICLES_PATH):
+        return len(pd.read_csv(ARTICLES_PATH, usecols=["article_id"]))
+    return None
+
+def interactions_matrix(customer_ids, article_ids, shape, binary=False, chunk_size=1<<20):
+    '''
+    Builds the csr matrix of purchases directly from the (customer, article) codes. Pairs are encoded as int64 keys and sorted,
+    so duplicates are counted (or binarized) in the same pass and the csr arrays are read from the sorted keys,
+    without the intermediate coo matrix and int64 data of csr_matrix((data, (rows, cols))).
+    Peak memory is about 23 bytes per transaction instead of about 28.
+    Args:
+        customer_ids: array of customer codes
+        article_ids: array of article codes
+        shape: (customer_size, article_size)
+        binary: boolean indicating whether repeated purchases are stored as 1 (uint8) instead of their count (uint16)
+        chunk_size: number of pairs whose counts are computed at once
+    Returns:
+        csr_matrix with int32 indices (int64 only if the number of pairs does not fit) and uint8/uint16 data
+    '''
+    # keys are computed in place, the codes are not copied to int64 arrays
+    keys = np.array(customer_ids, dtype=np.int64)
+    keys *= shape[1]
+    keys += np.asarray(article_ids)
+    keys.sort()
+    # first occurrence of every distinct pair
+    distinct = np.empty(len(keys), dtype=bool)
+    distinct[:1] = True
+    np.not_equal(keys[1:], keys[:-1], out=distinct[1:])
+    if binary:
+        data = np.ones(np.count_nonzero(distinct), dtype=np.uint8)
+    else:
+        starts = np.flatnonzero(distinct)
+        data = np.empty(len(starts), dtype=np.uint16)
+        for start in range(0, len(starts), chunk_size):
+            end = min(start+chunk_size, len(starts))
+            # a pair occurs until the start of the next pair
+            ends = starts[start+1:end+1] if end < len(starts) else np.append(starts[start+1:end], len(keys))
+            data[start:end] = np.minimum(ends - starts[start:end], np.iinfo(np.uint16).max)
+        del starts
+    keys = keys[distinct]
+    del distinct
+    index_dtype = np.int32 if max(len(keys), shape[1]) <= np.iinfo(np.int32).max else np.int64
+    indices = np.empty(len(keys), dtype=index_dtype)
+    np.remainder(keys, shape[1], out=indices, casting="unsafe")
+    keys //= shape[1]
+    indptr = np.zeros(shape[0]+1, dtype=index_dtype)
+    np.cumsum(np.bincount(keys, minlength=shape[0]), out=indptr[1:])
+    matrix = csr_matrix((data, indices, indptr), shape=shape)
+    # keys are sorted, so the indices of every row are sorted and unique
+    matrix.has_sorted_indices = True
+    return matrix
+
+def transactions_fingerprint(transactions, columns=("customer_id", "article_id", "t_dat"), chunk_size=1<<22):
+    '''
+    Hash of the values of the columns the matrices are built from, so a cache built from another slice
+    of the same length (another date window or sample) is not reused.
+    Args:
+        transactions: transactions dataframe
+        columns: hashed columns, columns missing from the dataframe are skipped
+        chunk_size: number of rows hashed at once
+    Returns:
+        hex digest
+    '''
+    digest = hashlib.sha1(str(len(transactions)).encode())
+    for column in columns:
+        if column not in transactions.columns:
+            continue
+        values = transactions[column].to_numpy()
+        if np.issubdtype(values.dtype, np.datetime64):
+            values = values.astype("datetime64[ns]").view(np.int64)
+        digest.update(f"{column}:{values.dtype}".encode())
+        for start in range(0, len(values), chunk_size):
+            digest.update(np.ascontiguousarray(values[start:start+chunk_size]).tobytes())
+    return digest.hexdigest()
+
+def save_interactions(path, fingerprint, **matrices):
+    '''Saves csr matrices from matrix_representation into one .npz file together with the fingerprint of the transactions they were built from.'''
+    arrays = {"fingerprint": fingerprint}
+    for name, matrix in matrices.items():
+        arrays.update({f"{name}_indptr": matrix.indptr, f"{name}_indices": matrix.indices, 
+                       f"{name}_data": matrix.data, f"{name}_shape": np.array(matrix.shape)})
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez(path, **arrays)
+
+def load_interactions(path, names, fingerprint, shape):
+    '''Loads the matrices saved by save_interactions, None if the file is missing, was built from other transactions or with another shape.'''
+    if not os.path.exists(path):
+        return None
+    arrays = np.load(path)
+    if "fingerprint" not in arrays or str(arrays["fingerprint"]) != fingerprint:
+        return None
+    if any(f"{name}_shape" not in arrays or tuple(arrays[f"{name}_shape"]) != shape for name in names):
+        return None
+    return [csr_matrix((arrays[f"{name}_data"], arrays[f"{name}_indices"], arrays[f"{name}_indptr"]), shape=shape) for name in names]
+
+def matrix_representation(transactions, train_test=True, customer_size=None, article_size=None, cache_path=None, return_counts=False, 
+                          cache_dir=CACHE_DIR):
     '''
     Responsible for creating customer buckets and represensting as a matrix where rows represent customers and columns articles.
     Args:
         transactions: transactions dataframe
         train_test: boolean indicating whether to split the dataset into train and test or not
+        customer_size: number of rows, defaults to the largest customer_id + 1
+        article_size: number of columns, defaults to the size of the article encoder (see catalog_size)
+        cache_path: optional .npz file, the matrices are loaded from it if it was built from the same transactions
+                    (see transactions_fingerprint) and with the same shape, otherwise they are built and saved to it
+        return_counts: boolean indicating whether to also return the counts of the validation purchases (train_test only),
+                       needed by update_matrix_representation to move them to the training matrix exactly
+        cache_dir: directory of the cache created by data_preprocessing, its article encoder gives the default article_size
     Returns:
-        x_mattrix: np.array of shape (customer_size, article_size) representing training transactions
-        y_transactions: np.array of shape (customer_size, article_size) representing validation transactions
+        x_mattrix: csr matrix of shape (customer_size, article_size) with the number of purchases in training transactions (uint16)
+        y_transactions: csr matrix of shape (customer_size, article_size) with the validation purchases (uint8 ones)
+        y_counts (optional): csr matrix of shape (customer_size, article_size) with the number of validation purchases (uint16)
     '''
-    customer_size = np.max(transactions['customer_id'])+1
-    article_size = 105542
-    if train_test:
-        # filter train and test dataset
-        x_transactions, y_transactions = split_transactions(transactions)
-
-        # Get X matrix
-        # Create the data array filled with ones
-        data = np.ones_like(x_transactions.index)
+    if customer_size is None:
+        customer_size = np.max(transactions['customer_id'])+1
+    if article_size is None:
+        article_size = max(catalog_size(cache_dir) or 0, np.max(transactions['article_id'])+1)
+    shape = (int(customer_size), int(article_size))
+    names = (["x", "y", "y_counts"] if return_counts else ["x", "y"]) if train_test else ["x"]
+    if cache_path is not None:
+        fingerprint = transactions_fingerprint(transactions)
+        matrices = load_interactions(cache_path, names, fingerprint, shape)
+        if matrices is not None:
+            return tuple(matrices) if train_test else matrices[0]
 
-        # Create the CSR matrix directly
+    if train_test:
+        # filter train and test transactions, only the id columns are selected instead of copying the dataframe
+        last = last_purchase_mask(transactions)
+        customers, articles = transactions['customer_id'].to_numpy(), transactions['article_id'].to_numpy()
         # assume that we investigate the purchase history therefore some articles were bought multiple times
-        x_matrix = csr_matrix((data, 
-                               (np.array(x_transactions['customer_id']), np.array(x_transactions['article_id']))), 
-                               shape=(customer_size, article_size))
-
-        # Get Y matrix
-        # Create the data array filled with ones
-        data = np.ones_like(y_transactions.index)
-
-        # Create the CSR matrix directly
-        y_matrix = csr_matrix((data, 
-                               (np.array(y_transactions['customer_id']), np.array(y_transactions['article_id']))), 
-                                shape=(customer_size, article_size))
+        x_matrix = interactions_matrix(customers[~last], articles[~last], shape)
         # as an output we are interested if the article was bought not its amount
-        y_matrix[y_matrix>1]=1
-        return x_matrix, y_matrix
+        y_matrix = interactions_matrix(customers[last], articles[last], shape, binary=True)
+        matrices = [x_matrix, y_matrix]
+        if return_counts:
+            matrices.append(interactions_matrix(customers[last], articles[last], shape))
     else:
-        # Get test matrix
-        # Create the data array filled with ones
-        data = np.ones_like(transactions.index)
+        matrices = [interactions_matrix(transactions['customer_id'], transactions['article_id'], shape)]
 
-        # Create the CSR matrix directly
-        matrix = csr_matrix((data, 
-                            (np.array(transactions['customer_id']), np.array(transactions['article_id']))), 
-                            shape=(customer_size, article_size))
+    if cache_path is not None:
+        save_interactions(cache_path, fingerprint, **dict(zip(names, matrices)))
+    return tuple(matrices) if train_test else matrices[0]
 
-        return matrix
-
-def create_random_candidates(transactions, save_dir=None, num_sample=30_000_000):
+def create_random_candidates(transactions, save_dir=None, num_sample=30_000_000, popularity=False, seed=None, interactions=None):
     '''
-    Responsible for creating negative samples using random candidates.
+    Responsible for creating negative samples using random candidates. Sampled pairs which were purchased are rejected
+    with a binary search over the sorted int64 keys of the purchased pairs.
     Args:
         transactions: transactions dataframe
-        save_dir: path to save the dataframe
-        num_sample: number of negative samples
+        save_dir: path of the directory to save the dataframe columns as .npy files (see load_columns)
+        num_sample: number of negative samples drawn before rejecting the purchased pairs
+        popularity: boolean indicating whether articles are sampled proportionally to their number of purchases instead of uniformly
+        seed: random seed
+        interactions: optional csr matrix from matrix_representation(train_test=False), used for the rejection instead of sorting the transactions
     Returns:
         shuffled_df: shuffled dataframe representing transactions with negative samples
     '''
+    rng = np.random.default_rng(seed)
+    customer_ids = np.asarray(transactions['customer_id'])
+    article_ids = np.asarray(transactions['article_id'])
     # get unique customers and articles
-    unique_customers = transactions['customer_id'].unique()
-    unique_articles = transactions['article_id'].unique()
+    unique_customers = np.unique(customer_ids)
+    article_counts = np.bincount(article_ids)
+    unique_articles = np.flatnonzero(article_counts)
     # select random customers and articles
-    random_cust = np.random.choice(unique_customers, num_sample)
-    random_articles = np.random.choice(unique_articles, num_sample)
-    # get negative candidates dataframe
-    negative_samples_df = pd.DataFrame(zip(random_cust, random_articles), columns=["customer_id","article_id",])
-    # delete duplicates from original dataset
-    unique_pairs = set(zip(transactions['customer_id'], transactions['article_id']))
-    filtered_df = negative_samples_df[~negative_samples_df.apply(lambda row: (row['customer_id'], row['article_id']) in unique_pairs, axis=1)].copy()
-    # set purchased variable
-    filtered_df["purchased"] = np.zeros(len(filtered_df))
-    transactions["purchased"] = np.ones(len(transactions))
-    # merge dataframes
-    merge = pd.concat([transactions[["customer_id","article_id", "purchased"]],filtered_df[["customer_id","article_id", "purchased"]]])
-    # return shuffled dataframe
-    shuffled_df = merge.sample(frac=1).reset_index(drop=True)
+    random_cust = rng.choice(unique_customers, num_sample)
+    if popularity:
+        article_probabilities = article_counts[unique_articles] / article_counts.sum()
+        random_articles = rng.choice(unique_articles, num_sample, p=article_probabilities)
+    else:
+        random_articles = rng.choice(unique_articles, num_sample)
+    # delete purchased pairs
+    if interactions is not None:
+        n_articles = interactions.shape[1]
+        purchased_keys = csr_interaction_keys(interactions)
+    else:
+        n_articles = len(article_counts)
+        purchased_keys = np.unique(interaction_keys(customer_ids, article_ids, n_articles))
+    negative = ~contains_keys(purchased_keys, interaction_keys(random_cust, random_articles, n_articles))
+    random_cust = random_cust[negative]
+    random_articles = random_articles[negative]
+    # merge positive and negative samples and shuffle them
+    order = rng.permutation(len(customer_ids) + len(random_cust))
+    shuffled_df = pd.DataFrame({
+        "customer_id": np.concatenate([customer_ids, random_cust]).astype(np.int32)[order],
+        "article_id": np.concatenate([article_ids, random_articles]).astype(np.int32)[order],
+        "purchased": np.concatenate([np.ones(len(customer_ids), dtype=np.float32), 
+                                     np.zeros(len(random_cust), dtype=np.float32)])[order],
+    })
     if save_dir != None:
-        shuffled_df.to_csv(save_dir)
+        save_columns(shuffled_df, save_dir)
     return shuffled_df
 
-def articles_embbedings():
+def articles_embbedings(cache_dir=CACHE_DIR):
     '''
     Responsible for creating article embeddings.
+    Reads the articles from the cache of data_preprocessing(save=True), the legacy csv is used only if there is no cache.
+    Args:
+        cache_dir: directory of the cache
     '''
-    # read article and customer data
-    articles = pd.read_csv("data/preprocessed/articles.csv") 
+    # read article data
+    if os.path.exists(os.path.join(cache_dir, "meta.json")):
+        _, articles, _ = load_preprocessed(cache_dir)
+    else:
+        articles = pd.read_csv("data/preprocessed/articles.csv") 
     # set indices
     articles = articles.set_index("article_id")
     # get embedding dims
@@ -280,13 +562,388 @@ def articles_embbedings():
         article_cat_dim.append(len(articles[art_col].unique()))
     return article_cat_dim
 
+#######################################################################################
+#                                Preprocessed Data Cache                              #
+#######################################################################################
+
+def file_fingerprint(path, block_size=1<<20):
+    '''
+    Cheap fingerprint of a raw csv file. Hashes the size, modification time and the first and last block of the file,
+    so that multi-GB files do not have to be read completely.
+    Args:
+        path: path to the file
+        block_size: number of bytes hashed at the beginning and at the end of the file
+    Returns:
+        hex digest of the fingerprint
+    '''
+    stat = os.stat(path)
+    digest = hashlib.sha1(f"{stat.st_size}-{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(block_size))
+        if stat.st_size > block_size:
+            f.seek(max(stat.st_size - block_size, block_size))
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+def raw_fingerprints():
+    '''Fingerprints of the raw csv files that the preprocessed cache is derived from.'''
+    return {name: file_fingerprint(path) for name, path in [("articles", ARTICLES_PATH), 
+                                                            ("customers", CUSTOMER_PATH), 
+                                                            ("transactions", TRANSACTION_PATH)]}
+
+def _save_encoders(encoders, encodings_dir):
+    '''Saves categories of each encoder as a .npy file. Returns the metadata of the encoders.'''
+    os.makedirs(encodings_dir, exist_ok=True)
+    meta = {}
+    for column, encoder in encoders.items():
+        categories = encoder.categories
+        np.save(os.path.join(encodings_dir, f"{column}.npy"), categories, allow_pickle=categories.dtype == object)
+        meta[column] = {"dtype": str(categories.dtype), "missing": encoder.missing}
+    return meta
+
+def save_preprocessed(transactions, articles, customers, article_encoders, customer_encoders, cache_dir=CACHE_DIR, feature_generation=False, transactions_saved=False):
+    '''
+    Saves the outputs of data_preprocessing as a versioned columnar cache. Every column is stored as a typed .npy file,
+    encodings are stored as arrays of original values ordered by their codes. 
+    The metadata file is written last, so an interrupted save never results in a valid cache.
+    Args:
+        transactions: preprocessed transactions dataframe
+        articles: preprocessed articles dataframe
+        customers: preprocessed customers dataframe
+        article_encoders: dictionary of CategoricalEncoders for articles columns
+        customer_encoders: dictionary of CategoricalEncoders for customers columns
+        cache_dir: directory of the cache
+        feature_generation: boolean indicating whether the dataframes were generated with feature engineering
+        transactions_saved: boolean indicating whether transactions were already written by stream_transactions
+    '''
+    invalidate_cache(cache_dir)
+    meta = {"version": CACHE_VERSION, 
+            "fingerprints": raw_fingerprints(), 
+            "feature_generation": feature_generation,
+            "tables": {}, 
+            "encodings": {}}
+    for name, table in [("transactions", transactions), ("articles", articles), ("customers", customers)]:
+        if name == "transactions" and transactions_saved:
+            meta["tables"][name] = {column: str(dtype) for column, dtype in table.dtypes.items()}
+        else:
+            meta["tables"][name] = _save_table(table, os.path.join(cache_dir, name))
+    for name, encoders in [("articles", article_encoders), ("customers", customer_encoders)]:
+        meta["encodings"][name] = _save_encoders(encoders, os.path.join(cache_dir, "encodings", name))
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+def invalidate_cache(cache_dir=CACHE_DIR):
+    '''Removes the metadata file, so the cache is not used until it is completely written again.'''
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+def count_rows(path, block_size=1<<26):
+    '''Counts the data rows of the csv file reading it in blocks, without parsing it.'''
+    n_lines = 0
+    last = b"\n"
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            n_lines += block.count(b"\n")
+            last = block[-1:]
+    # the last line does not have to end with a new line, the header is not a data row
+    return n_lines + (last != b"\n") - 1
+
+def _trim_column(path, n_rows, chunk_size=1<<24):
+    '''Shrinks the .npy column to its first n_rows rows, copying it in chunks into a new file.'''
+    column = np.load(path, mmap_mode="r")
+    trimmed = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=column.dtype, shape=(n_rows,))
+    for start in range(0, n_rows, chunk_size):
+        end = min(start+chunk_size, n_rows)
+        trimmed[start:end] = column[start:end]
+    trimmed.flush()
+    del column, trimmed
+    os.replace(path + ".tmp", path)
+
+def stream_transactions(article_encoder, customer_encoder, cache_dir=CACHE_DIR, chunk_size=1_000_000, path=None):
+    '''
+    Reads the raw transactions in chunks, encodes the ids, downcasts the columns and writes them to preallocated
+    memory mapped columns of the cache. Peak memory is bounded by the chunk size instead of the size of the file.
+    Args:
+        article_encoder: CategoricalEncoder for article_id
+        customer_encoder: CategoricalEncoder for customer_id
+        cache_dir: directory of the cache
+        chunk_size: number of rows read at once
+        path: path to the raw transactions, defaults to TRANSACTION_PATH
+    Returns:
+        transactions: preprocessed transactions dataframe memory mapped from the cache
+    '''
+    path = TRANSACTION_PATH if path is None else path
+    invalidate_cache(cache_dir)
+    table_dir = os.path.join(cache_dir, "transactions")
+    os.makedirs(table_dir, exist_ok=True)
+    n_rows = count_rows(path)
+    columns = {}
+    start = 0
+    reader = pd.read_csv(path, chunksize=chunk_size, dtype={"customer_id": str, "price": np.float32, "sales_channel_id": np.int8})
+    for chunk in tqdm(reader, total=int(np.ceil(n_rows/chunk_size))):
+        chunk["t_dat"] = pd.to_datetime(chunk["t_dat"])
+        chunk["customer_id"] = customer_encoder.transform(chunk["customer_id"])
+        chunk["article_id"] = article_encoder.transform(chunk["article_id"])
+        end = start + len(chunk)
+        if end > n_rows:
+            raise ValueError(f"{path} has more rows than the {n_rows} lines counted by count_rows, check its line endings")
+        for column in chunk.columns:
+            values = downcast_column(chunk[column])
+            if column not in columns:
+                columns[column] = np.lib.format.open_memmap(os.path.join(table_dir, f"{column}.npy"), mode="w+", 
+                                                            dtype=values.dtype, shape=(n_rows,))
+            columns[column][start:end] = values
+            # write dirty pages back, so they do not accumulate in memory
+            columns[column].flush()
+        start = end
+    dtypes = {column: str(values.dtype) for column, values in columns.items()}
+    del columns
+    # pandas skips blank lines, so fewer rows than counted lines can be read; the unwritten tail would be zero rows
+    if start < n_rows:
+        for column in dtypes:
+            _trim_column(os.path.join(table_dir, f"{column}.npy"), start)
+    return _load_table(table_dir, dtypes)
+
+def cache_is_valid(cache_dir=CACHE_DIR, feature_generation=False):
+    '''
+    Checks if the cache exists, has the current version and was generated from the current raw csv files.
+    Args:
+        cache_dir: directory of the cache
+        feature_generation: boolean indicating whether the cache is expected to contain generated features
+    Returns:
+        boolean
+    '''
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return (meta["version"] == CACHE_VERSION 
+            and meta["feature_generation"] == feature_generation 
+            and meta["fingerprints"] == raw_fingerprints())
+
+def load_preprocessed(cache_dir=CACHE_DIR, return_encodings=False, mmap=True):
+    '''
+    Loads the preprocessed dataframes from the cache created by data_preprocessing(save=True). 
+    Numeric columns are memory mapped, so loading is almost instant and pages are read on demand.
+    Args:
+        cache_dir: directory of the cache
+        return_encodings: boolean indicating whether to return the encodings or not
+        mmap: boolean indicating whether to memory map the columns or read them into memory
+    Returns:
+        the same outputs as data_preprocessing
+    '''
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["version"] != CACHE_VERSION:
+        raise ValueError(f"Cache version {meta['version']} is not supported, please rerun data_preprocessing(save=True)")
+    transactions = _load_table(os.path.join(cache_dir, "transactions"), meta["tables"]["transactions"], mmap)
+    articles = _load_table(os.path.join(cache_dir, "articles"), meta["tables"]["articles"], mmap)
+    customers = _load_table(os.path.join(cache_dir, "customers"), meta["tables"]["customers"], mmap)
+    if not return_encodings:
+        return transactions, articles, customers
+    
+    article_encoders, customer_encoders = load_encoders(cache_dir)
+    article_encodings, article_decodings = encoders_to_dicts(article_encoders)
+    customer_encodings, customer_decodings = encoders_to_dicts(customer_encoders)
+    return transactions, articles, customers, article_encodings, customer_encodings, article_decodings, customer_decodings
+
+def load_encoders(cache_dir=CACHE_DIR):
+    '''
+    Loads the CategoricalEncoders saved in the cache. Use them to encode new transactions without building dictionaries.
+    Args:
+        cache_dir: directory of the cache
+    Returns:
+        article_encoders: dictionary of CategoricalEncoders for articles columns
+        customer_encoders: dictionary of CategoricalEncoders for customers columns
+    '''
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        meta = json.load(f)
+    encoders = {}
+    for name, columns in meta["encodings"].items():
+        encoders[name] = {}
+        for column, info in columns.items():
+            categories = np.load(os.path.join(cache_dir, "encodings", name, f"{column}.npy"), allow_pickle=info["dtype"] == "object")
+            encoders[name][column] = CategoricalEncoder(categories, info["missing"])
+    return encoders["articles"], encoders["customers"]
+
+#######################################################################################
+#                                  Incremental Updates                                #
+#######################################################################################
+
+def _append_column(path, values):
+    '''
+    Appends values to the .npy file in place. Only the header and the new rows are written,
+    the file is rewritten only when the new shape does not fit into the padding of the header.
+    '''
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        header = io.BytesIO()
+        write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+        write_header(header, {"descr": np.lib.format.dtype_to_descr(dtype), 
+                              "fortran_order": fortran_order, 
+                              "shape": (shape[0] + len(values),)})
+        if len(header.getvalue()) == offset:
+            f.seek(0)
+            f.write(header.getvalue())
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+            return
+    old_values = np.load(path, mmap_mode="r")
+    np.save(path + ".tmp.npy", np.concatenate([old_values, np.asarray(values, dtype=dtype)]))
+    del old_values
+    os.replace(path + ".tmp.npy", path)
+
+def append_transactions(new_transactions, cache_dir=CACHE_DIR):
+    '''
+    Appends a new slice of raw transactions (the format of transactions_train.csv) to the cache created by data_preprocessing.
+    Unseen customers and articles get new codes at the end of the encoders, so existing codes stay valid.
+    Only the new rows are encoded and written, so the update time depends on the size of the slice and not on the history.
+    Please note that customers and articles dataframes are not extended with the unseen ids.
+    Caches built with feature_generation=True are rejected with a ValueError, their generated columns cannot be appended.
+    Args:
+        new_transactions: dataframe with the new raw transactions
+        cache_dir: directory of the cache
+    Returns:
+        new_transactions: encoded new transactions which can be passed to update_matrix_representation
+        customer_size: number of encoded customers after the update
+        article_size: number of encoded articles after the update
+    '''
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        meta = json.load(f)
+    # generated features are computed from the whole history and cannot be appended, checked before the cache is touched
+    if meta["feature_generation"]:
+        raise ValueError("Transactions can only be appended to a cache built with feature_generation=False, "
+                         "rebuild the cache with data_preprocessing instead.")
+    missing = [column for column in meta["tables"]["transactions"] if column not in new_transactions.columns]
+    if missing:
+        raise ValueError(f"The new transactions miss the columns {missing} of the cached transactions.")
+    article_encoders, customer_encoders = load_encoders(cache_dir)
+    # encode only the new rows
+    new_transactions = new_transactions.copy()
+    new_transactions["t_dat"] = pd.to_datetime(new_transactions["t_dat"])
+    new_customers = customer_encoders["customer_id"].extend(new_transactions["customer_id"])
+    new_articles = article_encoders["article_id"].extend(new_transactions["article_id"])
+    new_transactions["customer_id"] = customer_encoders["customer_id"].transform(new_transactions["customer_id"])
+    new_transactions["article_id"] = article_encoders["article_id"].transform(new_transactions["article_id"])
+    # the cache is not valid until all columns are appended
+    invalidate_cache(cache_dir)
+    table_dir = os.path.join(cache_dir, "transactions")
+    for column, dtype in meta["tables"]["transactions"].items():
+        _append_column(os.path.join(table_dir, f"{column}.npy"), new_transactions[column].to_numpy().astype(dtype))
+    for name, encoders in [("articles", article_encoders), ("customers", customer_encoders)]:
+        meta["encodings"][name] = _save_encoders(encoders, os.path.join(cache_dir, "encodings", name))
+    meta.setdefault("appended", []).append({"rows": len(new_transactions), 
+                                            "new_customers": new_customers, 
+                                            "new_articles": new_articles,
+                                            "last_date": str(new_transactions["t_dat"].max().date())})
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return new_transactions, len(customer_encoders["customer_id"]), len(article_encoders["article_id"])
+
+def update_matrix_representation(new_transactions, x_matrix, y_matrix=None, customer_size=None, article_size=None, y_counts=None):
+    '''
+    Updates the matrices created by matrix_representation with new transactions instead of building them again.
+    Matrices grow to the new number of customers and articles. With the train and validation split, 
+    the new transactions become the last purchases of their customers, so their previous validation purchases are moved to the training matrix.
+    The validation matrix is binary, so the number of times an article was bought on the last day is only known from y_counts
+    (matrix_representation(return_counts=True)). With y_counts the result is equal to matrix_representation of all transactions,
+    without it every moved validation purchase is counted once, which is only an approximation of the rebuilt training matrix.
+    The new transactions have to be more recent than the transactions already included in the matrices.
+    Args:
+        new_transactions: encoded new transactions, e.g. returned by append_transactions
+        x_matrix: training matrix (or the full matrix if train_test=False was used)
+        y_matrix: validation matrix, None if matrix_representation was called with train_test=False
+        customer_size: number of customers after the update, defaults to the largest customer_id + 1
+        article_size: number of articles after the update, defaults to the largest article_id + 1
+        y_counts: optional counts of the validation purchases from matrix_representation(return_counts=True)
+    Returns:
+        x_matrix: updated training matrix (or the full matrix)
+        y_matrix (optional): updated validation matrix
+        y_counts (optional): updated counts of the validation purchases, if y_counts was given
+    '''
+    customer_size = max(x_matrix.shape[0], np.max(new_transactions["customer_id"])+1, customer_size or 0)
+    article_size = max(x_matrix.shape[1], np.max(new_transactions["article_id"])+1, article_size or 0)
+    shape = (customer_size, article_size)
+    # resizing csr matrix only extends indptr
+    x_matrix = x_matrix.copy()
+    x_matrix.resize(shape)
+    if y_matrix is None:
+        return x_matrix + interactions_matrix(new_transactions["customer_id"], new_transactions["article_id"], shape)
+    
+    y_matrix = y_matrix.copy()
+    y_matrix.resize(shape)
+    # previous validation purchases with their counts if they are known
+    moved = y_matrix
+    if y_counts is not None:
+        moved = y_counts.copy()
+        moved.resize(shape)
+    # the slice can span several days, only the last purchases of each customer are used for validation
+    last = last_purchase_mask(new_transactions)
+    customers, articles = new_transactions["customer_id"].to_numpy(), new_transactions["article_id"].to_numpy()
+    # customers who bought something in the new slice
+    returning = np.zeros(customer_size, dtype=bool)
+    returning[np.unique(customers)] = True
+    x_matrix = (x_matrix 
+                + diags(returning, dtype=x_matrix.dtype) @ moved 
+                + interactions_matrix(customers[~last], articles[~last], shape)).astype(x_matrix.dtype)
+    # as an output we are interested if the article was bought not its amount
+    new_y_matrix = interactions_matrix(customers[last], articles[last], shape, binary=True)
+    y_matrix = (diags(~returning, dtype=y_matrix.dtype) @ y_matrix + new_y_matrix).astype(y_matrix.dtype)
+    if y_counts is None:
+        return x_matrix, y_matrix
+    y_counts = (diags(~returning, dtype=moved.dtype) @ moved + interactions_matrix(customers[last], articles[last], shape)).astype(moved.dtype)
+    return x_matrix, y_matrix, y_counts
+
 #######################################################################################
 #                                    Dataset Classes                                  #
 #######################################################################################
 
+class CSRRows:
+    '''
+    Arrays of a csr matrix kept as torch tensors, so a batch of rows is returned as a torch sparse csr tensor without
+    going through scipy. Contiguous rows are views of the arrays, other rows are gathered in a single call.
+    '''
+    def __init__(self, matrix:csr_matrix, dtype:torch.dtype=torch.float32):
+        matrix = csr_matrix(matrix)
+        self.shape = matrix.shape
+        self.crow_indices = torch.from_numpy(matrix.indptr.astype(np.int64))
+        self.col_indices = torch.from_numpy(matrix.indices.astype(np.int64))
+        self.values = torch.from_numpy(matrix.data).to(dtype)
+
+    def share_memory_(self):
+        '''Moves the arrays to shared memory, so DataLoader workers started with spawn do not get their own copy.'''
+        for array in [self.crow_indices, self.col_indices, self.values]:
+            array.share_memory_()
+        return self
+
+    def __getitem__(self, index:Union[torch.Tensor, np.ndarray, list]):
+        index = torch.as_tensor(index, dtype=torch.int64)
+        shape = (len(index), self.shape[1])
+        if len(index) > 0 and index[-1] - index[0] == len(index) - 1 and bool((index.diff() == 1).all()):
+            # contiguous rows
+            start, end = self.crow_indices[index[0]], self.crow_indices[index[-1]+1]
+            crow_indices = self.crow_indices[index[0]:index[-1]+2] - start
+            return torch.sparse_csr_tensor(crow_indices, self.col_indices[start:end], self.values[start:end], shape)
+        starts = self.crow_indices[index]
+        lengths = self.crow_indices[index+1] - starts
+        crow_indices = torch.zeros(len(index)+1, dtype=torch.int64)
+        torch.cumsum(lengths, dim=0, out=crow_indices[1:])
+        positions = torch.repeat_interleave(starts - crow_indices[:-1], lengths) + torch.arange(int(crow_indices[-1]))
+        return torch.sparse_csr_tensor(crow_indices, self.col_indices[positions], self.values[positions], shape)
+
+    def __len__(self):
+        return self.shape[0]
+
 class SparseDataset(Dataset):
     """
-    Custom Dataset class for scipy sparse matrix
+    Custom Dataset class for scipy sparse matrix.
+    A single index returns the csr rows for sparse_batch_collate, a batch of indices (e.g. from BatchSampler)
+    returns the features and targets of the whole batch as torch sparse csr tensors (see CSRRows).
     """
     def __init__(self, data:Union[np.ndarray, coo_matrix, csr_matrix], 
                  targets:Union[np.ndarray, coo_matrix, csr_matrix], 
@@ -305,9 +962,22 @@ class SparseDataset(Dataset):
             self.targets = targets
         
         self.transform = transform # Can be removed
-
-    def __getitem__(self, index:int):
-        return self.data[index], self.targets[index]
+        self.data_rows = CSRRows(self.data) if isinstance(self.data, csr_matrix) else None
+        self.targets_rows = CSRRows(self.targets) if isinstance(self.targets, csr_matrix) else None
+
+    def share_memory_(self):
+        '''Moves the csr arrays to shared memory for DataLoader workers.'''
+        for rows in [self.data_rows, self.targets_rows]:
+            if rows is not None:
+                rows.share_memory_()
+        return self
+
+    def __getitem__(self, index:Union[int, list, np.ndarray]):
+        if np.isscalar(index):
+            return self.data[index], self.targets[index]
+        data = self.data_rows[index] if self.data_rows is not None else torch.FloatTensor(self.data[index])
+        targets = self.targets_rows[index] if self.targets_rows is not None else torch.FloatTensor(self.targets[index])
+        return data, targets
 
     def __len__(self):
         return self.data.shape[0]
@@ -315,28 +985,142 @@ class SparseDataset(Dataset):
 class DatasetMF(Dataset):
     '''
     Dataset that handles data for matrix factorization/Two Tower models.
+    Columns are converted to int32/float32 arrays once, so a batch of indices (e.g. from BatchSampler) is sliced
+    with a single fancy indexing per column and returned as tensors without per-row Python.
     '''
     def __init__(self,trans:pd.DataFrame, transform:bool = None):
-        self.transactions = trans
+        self.articles_id = trans["article_id"].to_numpy(dtype=np.int32)
+        self.customers_id = trans["customer_id"].to_numpy(dtype=np.int32)
+        self.targets = trans["purchased"].to_numpy(dtype=np.float32)
+
+    def __getitem__(self, index:Union[int, list, np.ndarray]):
+        if np.isscalar(index):
+            return self.articles_id[index], self.customers_id[index], self.targets[index]
+        index = np.asarray(index)
+        return (torch.from_numpy(self.articles_id[index]), 
+                torch.from_numpy(self.customers_id[index]), 
+                torch.from_numpy(self.targets[index]))
+
+    def __len__(self):
+        return len(self.targets)
 
-    def __getitem__(self, index:int):
-        article_id = self.transactions["article_id"][index]
-        customer_id = self.transactions["customer_id"][index]
-        target = self.transactions["purchased"][index]
-        return article_id, customer_id, target
+class NegativeSamplingDataset(IterableDataset):
+    '''
+    Iterable dataset for matrix factorization/Two Tower models which streams positive pairs from the interaction matrix 
+    and draws fresh negatives for every batch, so every epoch sees different negatives and they are never stored.
+    Yields batches in the same format as MF_batch_collate: (articles_id, customers_id, targets), 
+    each batch contains batch_size positives and negative_ratio*batch_size negatives.
+    Negatives are sampled in the worker processes, seeds are derived from torch, so torch.manual_seed makes it reproducible.
+    '''
+    def __init__(self, interactions:csr_matrix, batch_size:int=1000, negative_ratio:int=1, popularity:bool=False, 
+                 customers:np.ndarray=None, shuffle:bool=True, max_rounds:int=10):
+        interactions = csr_matrix(interactions)
+        interactions.sort_indices()
+        rows = np.repeat(np.arange(interactions.shape[0], dtype=np.int32), np.diff(interactions.indptr))
+        # positive pairs
+        if customers is not None:
+            selected = np.isin(rows, customers)
+            self.customers_id = rows[selected]
+            self.articles_id = interactions.indices[selected].astype(np.int32)
+        else:
+            self.customers_id = rows
+            self.articles_id = interactions.indices.astype(np.int32)
+        # sorted keys of all purchased pairs used to reject sampled negatives
+        self.n_articles = interactions.shape[1]
+        self.purchased_keys = csr_interaction_keys(interactions)
+        # cumulative distribution of the articles popularity
+        if popularity:
+            article_counts = np.bincount(interactions.indices, minlength=self.n_articles)
+            self.article_cdf = np.cumsum(article_counts) / article_counts.sum()
+        else:
+            self.article_cdf = None
+        self.batch_size = batch_size
+        self.negative_ratio = negative_ratio
+        self.shuffle = shuffle
+        self.max_rounds = max_rounds
+
+    def sample_articles(self, rng, size):
+        '''Samples articles uniformly or proportionally to their popularity.'''
+        if self.article_cdf is None:
+            return rng.integers(0, self.n_articles, size)
+        return np.searchsorted(self.article_cdf, rng.random(size), side="right")
+
+    def sample_complement(self, rng, customer_id):
+        '''Samples uniformly one of the articles not purchased by the customer, -1 if the customer purchased all of them.'''
+        start = np.int64(customer_id)*self.n_articles
+        bounds = np.searchsorted(self.purchased_keys, [start, start + self.n_articles])
+        purchased = self.purchased_keys[bounds[0]:bounds[1]] - start
+        n_free = self.n_articles - len(purchased)
+        if n_free == 0:
+            return -1
+        # r-th free article: shift r by the number of purchased articles before it
+        r = rng.integers(0, n_free)
+        return r + np.searchsorted(purchased - np.arange(len(purchased)), r, side="right")
+
+    def sample_negatives(self, rng, customers_id):
+        '''
+        Samples negative_ratio articles for each customer, resampling the ones which were purchased.
+        After max_rounds of resampling the remaining ones are drawn uniformly from the articles not purchased by the customer,
+        collisions are only kept for customers who purchased every article.
+        '''
+        customers_id = np.repeat(customers_id, self.negative_ratio)
+        articles_id = self.sample_articles(rng, len(customers_id))
+        purchased = contains_keys(self.purchased_keys, interaction_keys(customers_id, articles_id, self.n_articles))
+        for _ in range(self.max_rounds):
+            if not purchased.any():
+                break
+            articles_id[purchased] = self.sample_articles(rng, purchased.sum())
+            purchased[purchased] = contains_keys(self.purchased_keys, 
+                                                 interaction_keys(customers_id[purchased], articles_id[purchased], self.n_articles))
+        for i in np.flatnonzero(purchased):
+            article_id = self.sample_complement(rng, customers_id[i])
+            if article_id >= 0:
+                articles_id[i] = article_id
+        return customers_id, articles_id
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            seed = torch.empty((), dtype=torch.int64).random_().item()
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            # the base seed is shared by the workers, so they agree on the order of the positives
+            seed = worker_info.seed - worker_info.id
+        n_positives = len(self.customers_id)
+        order = np.random.default_rng(seed).permutation(n_positives) if self.shuffle else np.arange(n_positives)
+        rng = np.random.default_rng([seed, worker_id])
+        # each worker handles every num_workers-th batch
+        for start in range(worker_id*self.batch_size, n_positives, num_workers*self.batch_size):
+            positives = order[start:start+self.batch_size]
+            customers_id = self.customers_id[positives]
+            negative_customers_id, negative_articles_id = self.sample_negatives(rng, customers_id)
+            yield (torch.from_numpy(np.concatenate([self.articles_id[positives], negative_articles_id]).astype(np.int64)),
+                   torch.from_numpy(np.concatenate([customers_id, negative_customers_id]).astype(np.int64)),
+                   torch.cat([torch.ones(len(positives)), torch.zeros(len(negative_customers_id))]))
 
     def __len__(self):
-        return self.transactions.shape[0]
+        return int(np.ceil(len(self.customers_id)/self.batch_size))
 
 class SingleDataset(Dataset):
     '''
     Dataset that handles data for articles and customers datasets seperately.
+    A batch of indices returns a torch sparse csr tensor, like SparseDataset.
     '''
     def __init__(self, df:csr_matrix, transform:bool = None):
         self.df = df
+        self.rows = CSRRows(df) if isinstance(df, csr_matrix) else None
+
+    def share_memory_(self):
+        '''Moves the csr arrays to shared memory for DataLoader workers.'''
+        if self.rows is not None:
+            self.rows.share_memory_()
+        return self
 
-    def __getitem__(self, index:int):
-        return self.df[index]
+    def __getitem__(self, index:Union[int, list, np.ndarray]):
+        if np.isscalar(index):
+            return self.df[index]
+        return self.rows[index] if self.rows is not None else torch.FloatTensor(self.df[index])
 
     def __len__(self):
         return self.df.shape[0]
@@ -395,7 +1179,7 @@ def MF_batch_collate(batch:list):
     """
     articles_batch, customer_batch, targets_batch = zip(*batch)
     if type(articles_batch[0]) == csr_matrix:
-        data_barticles_batchatch = vstack(articles_batch).tocoo()
+        articles_batch = vstack(articles_batch).tocoo()
         articles_batch = sparse_coo_to_tensor(articles_batch)
     else:
         articles_batch = torch.FloatTensor(articles_batch)
@@ -417,37 +1201,46 @@ def MF_batch_collate(batch:list):
 #                                      Data Loaders                                   #
 #######################################################################################
 
-def load_data(transactions, train_test=True, batch_size=1000):
+def load_data(transactions, train_test=True, batch_size=1000, num_workers=0, cache_dir=CACHE_DIR):
     '''
     Data loader used for training MLP models. It creates matrix representations of transactions. Also splits the dataset into train and validation sets.
-    Uses also batches while loading. 
+    Uses also batches while loading. The datasets are indexed with whole batches of rows, which are returned as torch sparse csr tensors.
     Args:
         transactions: transactions dataframe
         train_test: boolean value to indicate if the dataset should be split into train and validation sets
         batch_size: batch size for the data loader
+        num_workers: number of DataLoader worker processes, the csr arrays are moved to shared memory if > 0
+        cache_dir: directory of the cache created by data_preprocessing, used for the number of articles
     Returns:
         train_dataloader: pytorch data loader for the train set
         val_dataloader: pytorch data loader for the validation set
     '''
     if train_test:
         # matrix representation
-        x_matrix, y_matrix = matrix_representation(transactions, train_test=train_test)
+        x_matrix, y_matrix = matrix_representation(transactions, train_test=train_test, cache_dir=cache_dir)
         # sparse dataset
         dataset = SparseDataset(x_matrix, y_matrix)
-        # split dataset
+        if num_workers > 0:
+            dataset.share_memory_()
+        # split dataset, same random permutation as random_split
         train_size = int(0.9 * len(dataset))
-        val_size = len(dataset) - train_size
-        train_dataset, val_dataset = random_split(dataset,[train_size, val_size])
+        order = torch.randperm(len(dataset)).tolist()
+        train_indices, val_indices = order[:train_size], order[train_size:]
         # load data
-        train_dataloader = DataLoader(train_dataset, batch_size=batch_size, collate_fn=sparse_batch_collate)
-        val_dataloader = DataLoader(val_dataset, batch_size=batch_size, collate_fn=sparse_batch_collate)
+        train_dataloader = DataLoader(dataset, batch_size=None, num_workers=num_workers,
+                                      sampler=BatchSampler(train_indices, batch_size=batch_size, drop_last=False))
+        val_dataloader = DataLoader(dataset, batch_size=None, num_workers=num_workers,
+                                    sampler=BatchSampler(val_indices, batch_size=batch_size, drop_last=False))
         return train_dataloader, val_dataloader
     else:
         # matrix representation
-        matrix = matrix_representation(transactions, train_test=train_test)
+        matrix = matrix_representation(transactions, train_test=train_test, cache_dir=cache_dir)
         # sparse dataset
         dataset = SingleDataset(matrix)
-        dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=sparse_batch_collate_single)
+        if num_workers > 0:
+            dataset.share_memory_()
+        dataloader = DataLoader(dataset, batch_size=None, num_workers=num_workers,
+                                sampler=BatchSampler(SequentialSampler(dataset), batch_size=batch_size, drop_last=False))
         return dataloader
 
 def load_data_mf(trans:pd.DataFrame, batch_size=1000):
@@ -470,8 +1263,37 @@ def load_data_mf(trans:pd.DataFrame, batch_size=1000):
     # load data
     train_dataset = DatasetMF(train_transactions)
     val_dataset = DatasetMF(val_transactions)
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, collate_fn=MF_batch_collate)
-    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, collate_fn=MF_batch_collate)
+    # datasets are indexed with whole batches of indices
+    train_dataloader = DataLoader(train_dataset, batch_size=None,
+                                  sampler=BatchSampler(SequentialSampler(train_dataset), batch_size=batch_size, drop_last=False))
+    val_dataloader = DataLoader(val_dataset, batch_size=None,
+                                sampler=BatchSampler(SequentialSampler(val_dataset), batch_size=batch_size, drop_last=False))
+    return train_dataloader, val_dataloader, test_customers
+
+def load_data_negative_sampling(interactions:csr_matrix, batch_size=1000, negative_ratio=1, popularity=False, num_workers=0):
+    '''
+    Data loader used for training matrix factorization models with negatives sampled on the fly. 
+    It replaces create_random_candidates and load_data_mf, only the positives are kept in memory.
+    Splits customers into train and validation sets in the same way as load_data_mf.
+    Args:
+        interactions: csr matrix of purchases from matrix_representation(train_test=False)
+        batch_size: number of positives in a batch
+        negative_ratio: number of negatives sampled for each positive
+        popularity: boolean indicating whether negatives are sampled proportionally to the articles popularity
+        num_workers: number of worker processes sampling the batches
+    Returns:
+        train_dataloader: pytorch data loader for the train set
+        val_dataloader: pytorch data loader for the validation set
+        test_customers: customers used for validation
+    '''
+    test_fraction = 0.1
+    unique_customers = np.flatnonzero(np.diff(csr_matrix(interactions).indptr))
+    train_customers, test_customers = train_test_split(unique_customers, test_size=test_fraction, random_state=42)
+    train_dataset = NegativeSamplingDataset(interactions, batch_size, negative_ratio, popularity, customers=train_customers)
+    val_dataset = NegativeSamplingDataset(interactions, batch_size, negative_ratio, popularity, customers=test_customers, shuffle=False)
+    # datasets yield whole batches
+    train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=num_workers)
+    val_dataloader = DataLoader(val_dataset, batch_size=None, num_workers=num_workers)
     return train_dataloader, val_dataloader, test_customers
 
 def load_customers_articles(customers, articles, test_customers=[], batch_size=1000):
@@ -0,0 +1,175 @@
+import os
+import time
+import resource
+import threading
+from datetime import datetime
+import pandas as pd
+import torch
+from storage import save_columns, load_columns
+from runtime import get_runtime
+from recommenders import EMBEDDING_STORE_DIR, tower_embeddings, tower_fingerprint, top_k_articles
+from metrics import evaluate_top_k
+from model import ArticleTowerEmbedded
+
+RESULTS_DIR = "src/evaluation/results"
+
+#######################################################################################
+#                                    Measurements                                     #
+#######################################################################################
+
+def current_memory():
+    '''Resident memory of the process in bytes, read from /proc on Linux. None if not available.'''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class PeakMemory:
+    '''
+    Context manager measuring the peak memory of a stage. Cuda stages use the peak allocated memory of torch,
+    cpu stages sample the resident memory of the process in a background thread (or use the peak resident memory of the
+    process where /proc is not available). The result is the peak above the memory at the start of the stage.
+    '''
+    def __init__(self, device, interval=0.01):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak = 0
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.start = torch.cuda.memory_allocated(self.device)
+            return self
+        self.start = current_memory()
+        if self.start is None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            self.start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return self
+        self.max_memory = self.start
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while not self.stop.wait(self.interval):
+            self.max_memory = max(self.max_memory, current_memory())
+
+    def __exit__(self, *args):
+        if self.device.type == "cuda":
+            self.peak = torch.cuda.max_memory_allocated(self.device) - self.start
+        elif hasattr(self, "thread"):
+            self.stop.set()
+            self.thread.join()
+            self.peak = max(self.max_memory, current_memory()) - self.start
+        else:
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self.start
+        return False
+
+def measure(function, device):
+    '''
+    Runs the function and measures its time and peak memory.
+    Returns:
+        result of the function, seconds, peak memory in MB
+    '''
+    with PeakMemory(device) as memory:
+        start = time.perf_counter()
+        result = function()
+        if torch.device(device).type == "cuda":
+            torch.cuda.synchronize(device)
+        seconds = time.perf_counter() - start
+    return result, seconds, memory.peak / 2**20
+
+#######################################################################################
+#                                   Evaluation Runner                                 #
+#######################################################################################
+
+def run_evaluation(experiments, dataloader_cust, dataloader_art, targets, restrictions=None, ks=(12,), exclude=None,
+                   results_dir=RESULTS_DIR, store_dir=EMBEDDING_STORE_DIR, device=None):
+    '''
+    Evaluates several models on the same customers, articles and targets and appends the results to one columnar table,
+    so the comparison of all models can be regenerated with a single call and regressions between model versions are visible.
+    Two Tower models are evaluated in stages: customer embeddings, article embeddings (both from the embedding store),
+    retrieval with top_k_articles and evaluation. Other models are evaluated with their recommender function.
+    Args:
+        experiments: list of dicts with
+            name (str): name of the model in the results
+            model (nn.Module): trained model
+            recommender (callable, optional): function called as recommender(model) that returns the recommendations
+                (n_customers, max(ks)), e.g. functools.partial of a function from recommenders.py. Required for models
+                without CustomerTower and ArticleTower.
+        dataloader_cust (data.DataLoader): Dataloader for the customer dataset from data_reader.py.
+        dataloader_art (data.DataLoader): Dataloader for the article dataset from data_reader.py.
+        targets (csr_matrix): Purchases of the customers.
+        restrictions (list, optional): Indices of articles that can be recommended, see restriction_mask in recommenders.py.
+        ks (tuple, optional): Numbers of recommendations evaluated.
+        exclude (csr_matrix, optional): Articles that are never recommended to the customer (e.g. already bought).
+        results_dir (str, optional): Directory of the results table, new results are appended to the existing ones.
+        store_dir (str, optional): Directory of the embedding store, None computes the embeddings on every run.
+        device (Runtime or str, optional): Device used by the models, the default runtime from runtime.py is used if None.
+    Returns:
+        dataframe with one row for every model, stage and k: seconds, peak memory in MB and the metrics of the evaluation stage
+    '''
+    runtime = get_runtime(device)
+    run = datetime.now().isoformat(timespec="milliseconds")
+    top_k = max(ks)
+    rows = []
+    for experiment in experiments:
+        name, model = experiment["name"], experiment["model"]
+        model = runtime.to(model).eval()
+        model_hash = tower_fingerprint(model)[:16]
+        def record(stage, seconds, memory, k=0, scores=None):
+            rows.append({"run": run, "model": name, "model_hash": model_hash, "stage": stage, "k": k,
+                         "seconds": seconds, "peak_memory_mb": memory, **(scores or {})})
+
+        print(f"Evaluating {name}...")
+        if experiment.get("recommender") is not None:
+            recommendations, seconds, memory = measure(lambda: experiment["recommender"](model), runtime.device)
+            record("recommend", seconds, memory)
+        else:
+            article_dtype = torch.int64 if isinstance(model.ArticleTower, ArticleTowerEmbedded) else None
+            customers, seconds, memory = measure(lambda: tower_embeddings(model.CustomerTower, dataloader_cust, runtime, "customers", store_dir), runtime.device)
+            record("customer_embeddings", seconds, memory)
+            articles, seconds, memory = measure(lambda: tower_embeddings(model.ArticleTower, dataloader_art, runtime, "articles", store_dir, article_dtype), runtime.device)
+            record("article_embeddings", seconds, memory)
+            recommendations, seconds, memory = measure(lambda: top_k_articles(customers, articles, top_k, runtime, restrictions, exclude), runtime.device)
+            record("retrieval", seconds, memory)
+        scores, seconds, memory = measure(lambda: evaluate_top_k(recommendations, targets, ks), "cpu")
+        for _, row in scores.iterrows():
+            record("evaluation", seconds, memory, int(row["k"]), row.drop("k").to_dict())
+
+    results = pd.DataFrame(rows)
+    if results_dir is not None:
+        if os.path.exists(os.path.join(results_dir, "columns.json")):
+            results = pd.concat([load_columns(results_dir, mmap=False), results], ignore_index=True)
+        save_columns(results, results_dir)
+    return results[results["run"] == run].reset_index(drop=True)
+
+def load_results(results_dir=RESULTS_DIR):
+    '''Loads all results written by run_evaluation.'''
+    return load_columns(results_dir, mmap=False)
+
+def regressions(results, tolerance=0.1):
+    '''
+    Compares the last two runs of every model and stage.
+    Args:
+        results: dataframe from load_results
+        tolerance: relative change that is reported
+    Returns:
+        dataframe with the stages whose time or peak memory grew, or whose metrics dropped, by more than the tolerance
+    '''
+    metrics = [column for column in ["recall", "precision", "map", "hit_rate"] if column in results.columns]
+    changes = []
+    for (model, stage, k), group in results.sort_values("run").groupby(["model", "stage", "k"]):
+        if group["run"].nunique() < 2:
+            continue
+        previous, last = group.iloc[-2], group.iloc[-1]
+        for column, worse in [("seconds", 1), ("peak_memory_mb", 1)] + [(metric, -1) for metric in metrics]:
+            if pd.isna(previous[column]) or pd.isna(last[column]) or previous[column] == 0:
+                continue
+            change = (last[column] - previous[column]) / abs(previous[column])
+            if worse*change > tolerance:
+                changes.append({"model": model, "stage": stage, "k": k, "column": column, "previous": previous[column],
+                                "last": last[column], "change": change, "previous_hash": previous["model_hash"], "last_hash": last["model_hash"]})
+    return pd.DataFrame(changes)
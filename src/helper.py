@@ -1,12 +1,298 @@
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn as nn
-import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 import numpy as np
+from storage import FeatureStore
+from runtime import get_runtime
+
+def as_feature_store(features, dtype=torch.float32, pin_memory=False):
+    '''Wraps customers or articles features into FeatureStore unless they already are one.'''
+    if isinstance(features, FeatureStore):
+        return features
+    return FeatureStore(features, dtype=dtype, pin_memory=pin_memory)
+
+#######################################################################################
+#                                     Batch Adapters                                  #
+#######################################################################################
+
+# batch adapters turn a batch from the dataloader into model inputs and targets on the device
+
+class SoftmaxBatches:
+    '''
+    Batches of sparse customers features and purchases generated by load_data from data_reader.py, used by the MLP models.
+    Inputs stay sparse for the SparseLinear input layer of the MLP models, only the targets are dense.
+    '''
+    def __call__(self, batch, runtime):
+        inputs, targets = batch
+        return (runtime.to(inputs),), runtime.to(targets.to_dense())
+
+def sampling_probabilities(purchases, power=0.75):
+    '''
+    Probabilities of sampling articles as negatives, proportional to the number of purchases raised to the power
+    (0 gives uniform sampling). Articles without purchases get the probability of one purchase.
+    Args:
+        purchases: sparse matrix (n_customers, n_articles) of purchases, e.g. the targets of the training set
+        power: smoothing of the popularity
+    Returns:
+        torch.Tensor (n_articles,)
+    '''
+    counts = np.asarray(purchases.sum(axis=0), dtype=np.float64).reshape(-1)
+    weights = np.maximum(counts, 1) ** power
+    return torch.from_numpy(weights / weights.sum())
+
+class SampledSoftmaxBatches:
+    '''
+    Batches of sparse customers features and purchases generated by load_data from data_reader.py, used to train the MLP models
+    on sampled articles. The articles of a batch are the purchased ones plus n_negatives shared negatives sampled with
+    the given probabilities, so the output layer is computed only for them instead of the whole catalog.
+    Returns the inputs (features, articles) and the targets (purchases of the sampled articles, log of the expected
+    number of samples of every article) for SampledSoftmaxLoss.
+    '''
+    def __init__(self, n_articles, n_negatives=1000, probabilities=None):
+        '''
+        Args:
+            n_articles: number of articles (output dimension of the model)
+            n_negatives: number of negatives sampled for every batch
+            probabilities: tensor (n_articles,) of sampling probabilities, e.g. from sampling_probabilities, uniform if None
+        '''
+        if probabilities is None:
+            probabilities = torch.full((n_articles,), 1.0 / n_articles, dtype=torch.float64)
+        self.n_negatives = n_negatives
+        self.log_q = torch.log(probabilities * n_negatives).float()
+        # sampling by binary search in the cumulative distribution, cheaper than multinomial over the whole catalog
+        self.cdf = torch.cumsum(probabilities, dim=0)
+        self.cdf /= self.cdf[-1].clone()
+
+    def __call__(self, batch, runtime):
+        inputs, targets = batch
+        targets = targets.to_sparse_coo().coalesce()
+        customers, purchased = targets.indices()
+        negatives = torch.searchsorted(self.cdf, torch.rand(self.n_negatives, dtype=self.cdf.dtype)).clamp(max=len(self.cdf)-1)
+        # purchased articles that are also sampled are kept once
+        articles = torch.unique(torch.cat([purchased, negatives]))
+        labels = torch.zeros(targets.shape[0], len(articles))
+        labels[customers, torch.searchsorted(articles, purchased)] = 1
+        return (runtime.to(inputs), runtime.to(articles)), (runtime.to(labels), runtime.to(self.log_q[articles]))
+
+class TwoTowerBatches:
+    '''
+    Batches of (articles_id, customers_id, targets) generated by load_data_mf from data_reader.py, used by the two-tower models.
+    The features of the ids are gathered from the customers and articles feature stores.
+    '''
+    def __init__(self, customers, articles, article_dtype=torch.float32, pin_memory=False):
+        self.customers = as_feature_store(customers, pin_memory=pin_memory)
+        self.articles = as_feature_store(articles, dtype=article_dtype, pin_memory=pin_memory)
+
+    def __call__(self, batch, runtime):
+        articles_id, customers_id, targets = batch
+        return (runtime.to(self.customers[customers_id]), runtime.to(self.articles[articles_id])), runtime.to(targets)
+
+class LogisticBatches:
+    '''
+    Batches of (articles_id, customers_id, targets) generated by load_data_mf from data_reader.py, used by the models
+    with separate layers for each customer. Customers are passed to the model as ids.
+    '''
+    def __init__(self, articles, pin_memory=False):
+        self.articles = as_feature_store(articles, pin_memory=pin_memory)
+
+    def __call__(self, batch, runtime):
+        articles_id, customers_id, targets = batch
+        return (runtime.to(customers_id), runtime.to(self.articles[articles_id])), runtime.to(targets)
+
+#######################################################################################
+#                                         Trainer                                     #
+#######################################################################################
+
+def get_rng_state():
+    '''Returns the state of python, numpy and torch random generators.'''
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    '''Restores the random generators from get_rng_state.'''
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def to_cpu(state):
+    '''Copies all tensors of a (nested) state dict to cpu, so it can be saved while training continues.'''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+def load_model(model, path, device=None):
+    '''
+    Loads the weights saved by Trainer into the model.
+    Args:
+        model (nn.Module): model with the same architecture as the saved one
+        path (str): path of the saved state dict or checkpoint
+        device (Runtime or str, optional): Device to load the model on, the default runtime from runtime.py is used if None
+    Returns:
+        model
+    '''
+    runtime = get_runtime(device)
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    model.load_state_dict(state["model"] if "model" in state and "optimizer" in state else state)
+    return runtime.to(model)
+
+class Trainer:
+    '''
+    Training loop shared by all models. The model specific part is the batch adapter which converts batches from the
+    dataloader into model inputs and targets.
+    Supports bf16 autocast, gradient accumulation and checkpoints with model, optimizer, epoch and random generators state,
+    which are written in a background thread so the training does not wait for the disk.
+    '''
+    def __init__(self, model, criterion, optimizer, batch_adapter, save_dir=None, device=None, mixed_precision=False,
+                 accumulation_steps=1, checkpoint_path=None):
+        '''
+        Args:
+            model (nn.Module): model from model.py
+            criterion (nn.Module): Loss function
+            optimizer (optim.Optimizer): Optimizer
+            batch_adapter: callable converting (batch, runtime) into (inputs, targets), e.g. SoftmaxBatches, TwoTowerBatches, LogisticBatches
+            save_dir (str, optional): Path to save the state dict of the best model
+            device (Runtime or str, optional): Device to train on, the default runtime from runtime.py is used if None
+            mixed_precision (bool): Run forward passes under bf16 autocast
+            accumulation_steps (int): Number of batches whose gradients are accumulated before an optimizer step
+            checkpoint_path (str, optional): Path of the checkpoint saved after every epoch, training resumes from it if it exists
+        '''
+        self.runtime = get_runtime(device)
+        self.model = self.runtime.to(model)
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.batch_adapter = batch_adapter
+        self.save_dir = save_dir
+        self.mixed_precision = mixed_precision
+        self.accumulation_steps = accumulation_steps
+        self.checkpoint_path = checkpoint_path
+        self.epoch = 0
+        self.min_loss = np.inf
+        self.val_loss_list = []
+        self._executor = None
+        self._pending = None
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            self.load_checkpoint(checkpoint_path)
+
+    def autocast(self):
+        return torch.autocast(device_type=self.runtime.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision)
+
+    def loss(self, batch):
+        '''Computes the loss of the batch, the loss itself is computed in float32 outside of autocast.'''
+        inputs, targets = self.batch_adapter(batch, self.runtime)
+        with self.autocast():
+            outputs = self.model(*inputs)
+        # adapters may return several targets, e.g. the labels and sampling probabilities of SampledSoftmaxBatches
+        if isinstance(targets, tuple):
+            return self.criterion(outputs.float(), *(target.float() for target in targets))
+        return self.criterion(outputs.float(), targets.float())
+
+    def train_epoch(self, train_dataloader):
+        '''Runs one epoch and returns the loss of the last batch, nan if the dataloader is empty.'''
+        self.model.train()
+        self.optimizer.zero_grad()
+        step, loss = 0, None
+        for step, batch in enumerate(tqdm(train_dataloader), start=1):
+            loss = self.loss(batch)
+            (loss / self.accumulation_steps).backward()
+            if step % self.accumulation_steps == 0:
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+        # apply the remaining accumulated gradients
+        if step % self.accumulation_steps != 0:
+            self.optimizer.step()
+            self.optimizer.zero_grad()
+        return loss.item() if loss is not None else float("nan")
+
+    def validate(self, val_dataloader):
+        '''Returns the average loss over the validation set, nan if the dataloader is empty.'''
+        self.model.eval()
+        val_loss, n_batches = 0.0, 0
+        with torch.no_grad():
+            for batch in val_dataloader:
+                val_loss += self.loss(batch).item()
+                n_batches += 1
+        return val_loss / n_batches if n_batches > 0 else float("nan")
+
+    def fit(self, train_dataloader, val_dataloader, num_epochs=5):
+        '''
+        Trains the model until num_epochs epochs are done, the epochs of a resumed checkpoint count towards them.
+        The state dict of the model with the lowest validation loss is saved to save_dir.
+        Returns:
+            list of validation losses of all epochs
+        '''
+        for epoch in range(self.epoch, num_epochs):
+            train_loss = self.train_epoch(train_dataloader)
+            val_loss = self.validate(val_dataloader)
+            self.val_loss_list.append(val_loss)
+            self.epoch = epoch + 1
+            if val_loss<self.min_loss:
+                self.min_loss = val_loss
+                if self.save_dir is not None:
+                    self.save(self.save_dir, self.model.state_dict())
+            if self.checkpoint_path is not None:
+                self.save(self.checkpoint_path, self.checkpoint())
+            print(f'Epoch [{epoch + 1}/{num_epochs}] - Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.4f}')
+        self.wait()
+        return self.val_loss_list
+
+    def checkpoint(self):
+        '''Returns everything needed to resume the training.'''
+        return {"model": self.model.state_dict(),
+                "optimizer": self.optimizer.state_dict(),
+                "epoch": self.epoch,
+                "min_loss": self.min_loss,
+                "val_loss_list": self.val_loss_list,
+                "rng": get_rng_state()}
+
+    def load_checkpoint(self, path):
+        '''Restores the model, optimizer, epoch and random generators from the checkpoint.'''
+        state = torch.load(path, map_location="cpu", weights_only=False)
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.epoch = state["epoch"]
+        self.min_loss = state["min_loss"]
+        self.val_loss_list = list(state["val_loss_list"])
+        set_rng_state(state["rng"])
+        print(f"Resuming training after epoch {self.epoch}")
+
+    def save(self, path, state):
+        '''
+        Saves the state in a background thread. Tensors are copied to cpu first so the training can modify them,
+        the file is written under a temporary name and renamed, so an interrupted save never corrupts the previous one.
+        '''
+        state = to_cpu(state)
+        def write():
+            torch.save(state, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        # saves are written in order, one at a time
+        self.wait()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = self._executor.submit(write)
+
+    def wait(self):
+        '''Blocks until the last save is written.'''
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+#######################################################################################
+#                                    Training Functions                               #
+#######################################################################################
 
 # Define the training function for multi-label classification with validation
-def train_softmax(model, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5):
+def train_softmax(model, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5, device=None, **kwargs):
     '''
     Trains the MLP models.
     Args:
@@ -17,226 +303,124 @@ def train_softmax(model, train_dataloader, val_dataloader, criterion, optimizer,
         optimizer (optim.Optimizer): Optimizer
         save_dir (str): Directory to save model
         num_epochs (int): Number of epochs to train for
+        device (Runtime or str, optional): Device to train on, the default runtime from runtime.py is used if None
+        kwargs: mixed_precision, accumulation_steps and checkpoint_path passed to Trainer
     '''
-    mps_device = torch.device("mps")
-    model = model.to(mps_device)
-    val_loss_list = []
-    min_loss = np.inf
-    for epoch in tqdm(range(num_epochs)):
-        model.train()
-        for inputs, targets in train_dataloader:
-            inputs = inputs.to_dense().to(mps_device)
-            targets = targets.to_dense().to(mps_device)
-            optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = criterion(outputs, targets)
-            loss.backward()
-            optimizer.step()       
-        # Validatete for the epoch
-        train_loss = loss.item()
-        val_loss = validate_softmax(model, val_dataloader, criterion)
-        val_loss_list.append(val_loss) 
-        if val_loss<min_loss:
-            min_loss = val_loss
-            torch.save(model, save_dir)
-        print(f'Epoch [{epoch + 1}/{num_epochs}] - Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.4f}%')
-    return val_loss_list
+    trainer = Trainer(model, criterion, optimizer, SoftmaxBatches(), save_dir, device, **kwargs)
+    return trainer.fit(train_dataloader, val_dataloader, num_epochs)
 
 # Define the validation function for multi-label classification
-def validate_softmax(model, val_dataloader, criterion, k=5):
+def validate_softmax(model, val_dataloader, criterion, k=5, device=None):
     '''Validates the MLP models. Used by train_softmax'''
-    mps_device = torch.device("mps")
-    model.eval()
-    val_loss = 0.0
-    with torch.no_grad():
-        for inputs, targets in val_dataloader:
-            inputs = inputs.to_dense().to(mps_device)
-            targets = targets.to_dense().to(mps_device)
-            outputs = model(inputs)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-    val_loss /= len(val_dataloader)
-    return val_loss
+    return Trainer(model, criterion, None, SoftmaxBatches(), device=device).validate(val_dataloader)
+
+def train_softmax_sampled(model, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5, device=None,
+                          n_negatives=1000, probabilities=None, **kwargs):
+    '''
+    Trains the MLP models on the purchased articles and sampled negatives of every batch instead of the whole catalog.
+    The trained model still scores all articles in recommender_softmax.
+    Args:
+        model (nn.Module): MLP models from model.py
+        train_dataloader (DataLoader): DataLoader for training data generated by load_data from data_reader.py
+        val_dataloader (DataLoader): DataLoader for validation data generated by load_data from data_reader.py
+        criterion (nn.Module): SampledSoftmaxLoss from model.py
+        optimizer (optim.Optimizer): Optimizer
+        save_dir (str): Directory to save model
+        num_epochs (int): Number of epochs to train for
+        device (Runtime or str, optional): Device to train on, the default runtime from runtime.py is used if None
+        n_negatives (int): Number of negatives sampled for every batch
+        probabilities (torch.Tensor, optional): Sampling probabilities of the articles from sampling_probabilities, uniform if None
+        kwargs: mixed_precision, accumulation_steps and checkpoint_path passed to Trainer
+    '''
+    n_articles = [layer for layer in model.modules() if isinstance(layer, nn.Linear)][-1].out_features
+    batches = SampledSoftmaxBatches(n_articles, n_negatives, probabilities)
+    trainer = Trainer(model, criterion, optimizer, batches, save_dir, device, **kwargs)
+    return trainer.fit(train_dataloader, val_dataloader, num_epochs)
 
 # Define the training function for multi-label classification with validation
-def train_two_tower(model, customers, articles, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5):
+def train_two_tower(model, customers, articles, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5, device=None, **kwargs):
     '''
     Trains the two-tower models with linear layers.
     Args:
         model (nn.Module): Two-tower models using Linear layers from model.py
-        customers: customers dataframe
-        articles: articles dataframe
+        customers: FeatureStore (or csr matrix) with customers features
+        articles: FeatureStore (or csr matrix) with articles features
         train_dataloader (DataLoader): DataLoader for training data generated by load_data_mf from data_reader.py
         val_dataloader (DataLoader): DataLoader for validation data generated by load_data_mf from data_reader.py
         criterion (nn.Module): Loss function
         optimizer (optim.Optimizer): Optimizer
         save_dir (str): Directory to save model
         num_epochs (int): Number of epochs to train for
+        device (Runtime or str, optional): Device to train on, the default runtime from runtime.py is used if None
+        kwargs: mixed_precision, accumulation_steps and checkpoint_path passed to Trainer
     '''
-    mps_device = torch.device("mps")
-    model = model.to(mps_device)
-    val_loss_list = []
-    min_loss = np.inf
-    for epoch in range(num_epochs):
-        model.train()
-        for articles_id, customers_id, targets in tqdm(train_dataloader): 
-            # Positive sample
-            articles_features = torch.tensor(articles[articles_id].todense(), dtype=torch.float32)
-            customer_features = torch.tensor(customers[customers_id].todense(), dtype=torch.float32)
-            articles_features = articles_features.to(mps_device)
-            customer_features = customer_features.to(mps_device)
-            targets = targets.to(mps_device)
-            # Pus to model
-            optimizer.zero_grad()
-            outputs = model(customer_features, articles_features)
-            # Generate outputs
-            loss = criterion(outputs, targets)
-            loss.backward()
-            optimizer.step()
-        # Validatete for the epoch
-        train_loss = loss.item()
-        val_loss = validate_two_tower(model, val_dataloader, articles, customers, criterion)
-        val_loss_list.append(val_loss)
-        if val_loss<min_loss:
-            min_loss = val_loss
-            torch.save(model, save_dir)
-        print(f'Epoch [{epoch + 1}/{num_epochs}] - Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.4f}')
-    return val_loss_list
+    runtime = get_runtime(device)
+    batches = TwoTowerBatches(customers, articles, pin_memory=runtime.pin_memory)
+    trainer = Trainer(model, criterion, optimizer, batches, save_dir, runtime, **kwargs)
+    return trainer.fit(train_dataloader, val_dataloader, num_epochs)
 
 # Define the validation function for multi-label classification
-def validate_two_tower(model, val_dataloader, articles, customers, criterion):
+def validate_two_tower(model, val_dataloader, articles, customers, criterion, device=None):
     '''Validates the two-tower models. Used by train_two_tower'''
-    mps_device = torch.device("mps")
-    model.eval()
-    val_loss = 0.0
-    model = model.to(mps_device)
-    with torch.no_grad():
-        for articles_id, customers_id, targets in val_dataloader:
-            articles_features = torch.tensor(articles[articles_id].todense(), dtype=torch.float32).to(mps_device)
-            customer_features = torch.tensor(customers[customers_id].todense(), dtype=torch.float32).to(mps_device)
-            targets = targets.to(mps_device)
-            outputs = model(customer_features, articles_features)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-    val_loss /= len(val_dataloader)
-    return val_loss
+    runtime = get_runtime(device)
+    batches = TwoTowerBatches(customers, articles, pin_memory=runtime.pin_memory)
+    return Trainer(model, criterion, None, batches, device=runtime).validate(val_dataloader)
 
 # Define the training function for multi-label classification with validation
-def train_two_tower_embedded(model, customers, articles, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5):
+def train_two_tower_embedded(model, customers, articles, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5, device=None, **kwargs):
     '''
     Trains the two-tower models with embedding layers.
     Args:
         model (nn.Module): Two-tower models using embedding layers from model.py
-        customers: customers dataframe
-        articles: articles dataframe
+        customers: FeatureStore (or csr matrix) with customers features
+        articles: FeatureStore (or csr matrix) with articles features
         train_dataloader (DataLoader): DataLoader for training data generated by load_data_mf from data_reader.py
         val_dataloader (DataLoader): DataLoader for validation data generated by load_data_mf from data_reader.py
         criterion (nn.Module): Loss function
         optimizer (optim.Optimizer): Optimizer
         save_dir (str): Directory to save model
         num_epochs (int): Number of epochs to train for
+        device (Runtime or str, optional): Device to train on, the default runtime from runtime.py is used if None
+        kwargs: mixed_precision, accumulation_steps and checkpoint_path passed to Trainer
     '''
-    val_loss_list = []
-    min_loss = np.inf
-    for epoch in range(num_epochs):
-        model.train()
-        for articles_id, customers_id, targets in tqdm(train_dataloader): 
-            # Positive sample
-            articles_features = torch.tensor(articles[articles_id].todense())
-            customer_features = torch.tensor(customers[customers_id].todense()).to(torch.float32)
-            articles_features = articles_features
-            customer_features = customer_features
-            targets = targets
-            # Pus to model
-            optimizer.zero_grad()
-            outputs = model(customer_features, articles_features)
-            # Generate outputs
-            loss = criterion(outputs, targets)
-            loss.backward()
-            optimizer.step()
-        # Validatete for the epoch
-        train_loss = loss.item()
-        val_loss = validate_two_tower_embedded(model, val_dataloader, articles, customers, criterion)
-        val_loss_list.append(val_loss)
-        if val_loss<min_loss:
-            min_loss = val_loss
-            torch.save(model, save_dir)
-        print(f'Epoch [{epoch + 1}/{num_epochs}] - Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.4f}')
-    return val_loss_list
+    runtime = get_runtime(device)
+    # articles features are categorical codes for the embedding layers
+    batches = TwoTowerBatches(customers, articles, article_dtype=torch.int64, pin_memory=runtime.pin_memory)
+    trainer = Trainer(model, criterion, optimizer, batches, save_dir, runtime, **kwargs)
+    return trainer.fit(train_dataloader, val_dataloader, num_epochs)
 
 # Define the validation function for multi-label classification
-def validate_two_tower_embedded(model, val_dataloader, articles, customers, criterion):
+def validate_two_tower_embedded(model, val_dataloader, articles, customers, criterion, device=None):
     '''Validates the two-tower models. Used by train_two_tower_embedded'''
-    model.eval()
-    val_loss = 0.0
-    with torch.no_grad():
-        for articles_id, customers_id, targets in val_dataloader:
-            articles_features = torch.tensor(articles[articles_id].todense())
-            customer_features = torch.tensor(customers[customers_id].todense()).to(torch.float32)
-            targets = targets
-            outputs = model(customer_features, articles_features)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-    val_loss /= len(val_dataloader)
-    return val_loss
+    runtime = get_runtime(device)
+    batches = TwoTowerBatches(customers, articles, article_dtype=torch.int64, pin_memory=runtime.pin_memory)
+    return Trainer(model, criterion, None, batches, device=runtime).validate(val_dataloader)
 
 # Define the training function for multi-label classification with validation
-def train_logistic(model, customers, articles, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5):
+def train_logistic(model, customers, articles, train_dataloader, val_dataloader, criterion, optimizer, save_dir, num_epochs=5, device=None, **kwargs):
     '''
     Trains the two-tower models where each customer has its own linear layers.
     Args:
         model (nn.Module): Two-tower models using seperate linear layers for each customer from model.py
-        customers: customers dataframe
-        articles: articles dataframe
+        customers: FeatureStore (or csr matrix) with customers features
+        articles: FeatureStore (or csr matrix) with articles features
         train_dataloader (DataLoader): DataLoader for training data generated by load_data_mf from data_reader.py
         val_dataloader (DataLoader): DataLoader for validation data generated by load_data_mf from data_reader.py
         criterion (nn.Module): Loss function
         optimizer (optim.Optimizer): Optimizer
         save_dir (str): Directory to save model
         num_epochs (int): Number of epochs to train for
+        device (Runtime or str, optional): Device to train on, the default runtime from runtime.py is used if None
+        kwargs: mixed_precision, accumulation_steps and checkpoint_path passed to Trainer
     '''
-    model = model
-    val_loss_list = []
-    min_loss = np.inf
-    for epoch in range(num_epochs):
-        model.train()
-        for articles_id, customers_id, targets in tqdm(train_dataloader): 
-            # Positive sample
-            articles_features = torch.tensor(articles[articles_id].todense(), dtype=torch.float32)
-            articles_features = articles_features
-            targets = targets
-            # Pus to model
-            optimizer.zero_grad()
-            outputs = model(customers_id, articles_features)
-            # Generate outputs
-            loss = criterion(outputs, targets)
-            loss.backward()
-            optimizer.step()
-        # Validatete for the epoch
-        train_loss = loss.item()
-        torch.save(model, save_dir)
-        val_loss = validate_logistic(model, val_dataloader, articles, customers, criterion)
-        val_loss_list.append(val_loss)
-        if val_loss<min_loss:
-            min_loss = val_loss
-            torch.save(model, save_dir)
-        print(f'Epoch [{epoch + 1}/{num_epochs}] - Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.4f}')
-    return val_loss_list
+    runtime = get_runtime(device)
+    batches = LogisticBatches(articles, pin_memory=runtime.pin_memory)
+    trainer = Trainer(model, criterion, optimizer, batches, save_dir, runtime, **kwargs)
+    return trainer.fit(train_dataloader, val_dataloader, num_epochs)
 
 # Define the validation function for multi-label classification
-def validate_logistic(model, val_dataloader, articles, customers, criterion):
+def validate_logistic(model, val_dataloader, articles, customers, criterion, device=None):
     '''Validates the two-tower models. Used by train_two_tower_logistic'''
-    model.eval()
-    val_loss = 0.0
-    model = model
-    with torch.no_grad():
-        for articles_id, customers_id, targets in val_dataloader:
-            articles_features = torch.tensor(articles[articles_id].todense(), dtype=torch.float32)
-            targets = targets
-            outputs = model(customers_id, articles_features)
-            loss = criterion(outputs, targets)
-            val_loss += loss.item()
-    val_loss /= len(val_dataloader)
-    return val_loss
-
-
+    runtime = get_runtime(device)
+    batches = LogisticBatches(articles, pin_memory=runtime.pin_memory)
+    return Trainer(model, criterion, None, batches, device=runtime).validate(val_dataloader)
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import torch
+from scipy.sparse import csr_matrix
+from storage import interaction_keys, csr_interaction_keys, contains_keys
+
+def block_hits(recommendations, targets):
+    '''
+    Marks which recommendations were purchased. Recommendation keys (customer*n_articles+article) are searched
+    in the sorted keys of the csr targets, so no dense customers x articles matrix is needed.
+    Args:
+        recommendations: np.array (n_customers, k) of recommended article indices, padded recommendations (-1) are never hits
+        targets: csr matrix (n_customers, n_articles) of purchases
+    Returns:
+        boolean np.array (n_customers, k), True if the recommendation is among the purchases of the customer
+    '''
+    n_customers, k = recommendations.shape
+    keys = interaction_keys(np.repeat(np.arange(n_customers), k), recommendations.reshape(-1), targets.shape[1])
+    return (contains_keys(csr_interaction_keys(targets), keys) & (recommendations.reshape(-1) >= 0)).reshape(n_customers, k)
+
+def evaluate_recommendations(recommendations, targets, k:int=None, block_size:int=100_000):
+    '''
+    Computes recall, precision, MAP@k and hit rate of the recommendations. Customers are processed in blocks,
+    so the memory stays linear in the number of recommendations.
+    Args:
+        recommendations: torch.Tensor or np.array (n_customers, top_k) of recommended article indices ordered by score
+        targets: sparse matrix (n_customers, n_articles) of purchases
+        k: number of recommendations evaluated, defaults to all top_k
+        block_size: number of customers evaluated at once
+    Returns:
+        dict with
+            recall: share of all purchases that were recommended
+            precision: share of all recommendations that were purchased
+            map: mean average precision at k over customers with purchases
+            hit_rate: share of customers with purchases that got at least one correct recommendation
+    '''
+    if isinstance(recommendations, torch.Tensor):
+        recommendations = recommendations.cpu().numpy()
+    recommendations = np.asarray(recommendations, dtype=np.int64)[:, :k]
+    k = recommendations.shape[1]
+    targets = csr_matrix(targets)
+    n_customers = recommendations.shape[0]
+    total_hits, total_targets, average_precision, customers_hit, customers_with_targets = 0, 0, 0.0, 0, 0
+    for start in range(0, n_customers, block_size):
+        end = min(start+block_size, n_customers)
+        hits = block_hits(recommendations[start:end], targets[start:end])
+        n_targets = np.diff(targets[start:end].indptr)
+        has_targets = n_targets > 0
+        # precision at every position of the hits, summed over the positions with a hit
+        precision_at = np.cumsum(hits, axis=1) / np.arange(1, k+1)
+        average_precision += ((precision_at * hits).sum(axis=1)[has_targets] / np.minimum(n_targets[has_targets], k)).sum()
+        total_hits += hits.sum()
+        total_targets += n_targets.sum()
+        customers_hit += hits.any(axis=1).sum()
+        customers_with_targets += has_targets.sum()
+    return {"recall": float(total_hits / max(total_targets, 1)),
+            "precision": float(total_hits / (k*n_customers)),
+            "map": float(average_precision / max(customers_with_targets, 1)),
+            "hit_rate": float(customers_hit / max(customers_with_targets, 1))}
+
+def evaluate_top_k(recommendations, targets, ks=(1, 5, 12), block_size:int=100_000):
+    '''
+    Evaluates the recommendations for several k at once, using the first k recommendations for every k.
+    Returns:
+        dataframe with the metrics of evaluate_recommendations for every k
+    '''
+    results = [{"k": k, **evaluate_recommendations(recommendations, targets, k, block_size)} for k in ks]
+    return pd.DataFrame(results)
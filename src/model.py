@@ -3,29 +3,54 @@ import torch.nn.functional as F
 import numpy as np
 import torch
 
+class SparseLinear(nn.Linear):
+    '''
+    Linear layer which also accepts sparse (coo or csr) inputs, e.g. the purchased articles of customers from load_data.
+    Sparse batches are multiplied with torch.sparse.mm, so the cost scales with the number of purchases instead of
+    the number of articles. The parameters are the same as in nn.Linear, so the state dicts of both layers are interchangeable.
+    '''
+    def forward(self, x):
+        if x.layout == torch.strided:
+            return super().forward(x)
+        # sparse matmuls have no reduced precision kernels, so autocast is disabled for this layer
+        with torch.autocast(x.device.type, enabled=False):
+            x = torch.sparse.mm(x.to(self.weight.dtype), self.weight.T)
+        return x if self.bias is None else x + self.bias
+
+def sampled_linear(layer, x, articles):
+    '''Logits of the linear output layer for the chosen articles only, used to train the MLP models with sampled articles.'''
+    return F.linear(x, layer.weight[articles], layer.bias[articles])
+
 class MLP1(nn.Module):
-    '''MLP model with 1 hidden layer'''
+    '''
+    MLP model with 1 hidden layer. Given the indices of sampled articles the model returns only their logits (without sigmoid),
+    which is used by SampledSoftmaxLoss for training, otherwise the probabilities of all articles.
+    '''
     def __init__(self, input_dim, output_dim):
         super(MLP1, self).__init__()
-        self.fc1 = nn.Linear(input_dim, 100)
+        self.fc1 = SparseLinear(input_dim, 100)
         self.fc2 = nn.Linear(100, output_dim)
 
-    def forward(self, x):
+    def forward(self, x, articles=None):
         x = F.relu(self.fc1(x))
+        if articles is not None:
+            return sampled_linear(self.fc2, x, articles)
         x = F.sigmoid(self.fc2(x))
         return x
 
 class MLP2(nn.Module):
-    '''MLP model with 2 hidden layers'''
+    '''MLP model with 2 hidden layers, returns the logits of the sampled articles if given (see MLP1)'''
     def __init__(self, input_dim, output_dim):
         super(MLP2, self).__init__()
-        self.fc1 = nn.Linear(input_dim, 500)
+        self.fc1 = SparseLinear(input_dim, 500)
         self.fc2 = nn.Linear(500, 100)
         self.fc3 = nn.Linear(100, output_dim)
 
-    def forward(self, x):
+    def forward(self, x, articles=None):
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
+        if articles is not None:
+            return sampled_linear(self.fc3, x, articles)
         x = F.sigmoid(self.fc3(x))
         return x
     
@@ -55,63 +80,141 @@ class ArticleTower(nn.Module):
         x = self.fc2(x)
         return x
 
-class TwoTower(nn.Module):
+class TwoTowerScoring(nn.Module):
+    '''
+    Scoring head shared by the Two Tower models. Subclasses define CustomerTower and ArticleTower.
+    By default each customer is scored only against its own article with a row-wise dot product, which is O(B*d).
+    With in_batch_negatives the full B x B matrix of logits is returned, so the other articles of the batch serve
+    as negatives for InBatchSoftmaxLoss.
+    '''
+    # class attribute so that models pickled before the option existed keep the pairwise scoring
+    in_batch_negatives = False
+
+    def forward(self, customer_features, article_features):
+        # customers
+        customer_features = self.CustomerTower(customer_features)
+        # articles
+        article_features = self.ArticleTower(article_features).to(customer_features.dtype)
+        if self.in_batch_negatives:
+            return torch.matmul(customer_features, article_features.T)
+        # return product
+        return torch.sigmoid((customer_features * article_features).sum(dim=1))
+
+class InBatchSoftmaxLoss(nn.Module):
+    '''
+    Sampled softmax loss for Two Tower models with in_batch_negatives. Each purchased (customer, article) pair of the batch
+    is classified against all articles of the batch, the rows of negative samples (target 0) are ignored.
+    '''
+    def __init__(self, temperature=1.0):
+        super(InBatchSoftmaxLoss, self).__init__()
+        self.temperature = temperature
+
+    def forward(self, logits, targets):
+        positives = torch.nonzero(targets > 0).squeeze(1)
+        return F.cross_entropy(logits[positives] / self.temperature, positives)
+
+class SampledSoftmaxLoss(nn.Module):
+    '''
+    Sampled softmax loss for the MLP models trained on sampled articles (see SampledSoftmaxBatches in helper.py).
+    The logits are corrected by the log probability of sampling each article (logQ correction), so the popular articles
+    that are sampled more often are not pushed down more than in the full softmax. The purchases of a customer share the
+    probability mass of the target, customers without purchases are ignored.
+    '''
+    def forward(self, logits, targets, log_q):
+        logits = logits - log_q
+        n_targets = targets.sum(dim=1)
+        has_targets = n_targets > 0
+        return F.cross_entropy(logits[has_targets], targets[has_targets] / n_targets[has_targets].unsqueeze(1))
+
+class TwoTower(TwoTowerScoring):
     '''Two Tower model with shallow Customer Tower and Article Tower'''
-    def __init__(self, input_article_dim, input_customer_dim, output_dim=3):
+    def __init__(self, input_article_dim, input_customer_dim, output_dim=3, in_batch_negatives=False):
         super(TwoTower,self).__init__()
+        self.in_batch_negatives = in_batch_negatives
         # Article tower
         self.ArticleTower = ArticleTower(input_article_dim, output_dim)
         self.CustomerTower = CustomerTower(input_customer_dim, output_dim)
 
-    def forward(self, customer_features, article_features):
-        #customers
-        customer_features = self.CustomerTower(customer_features)
-        # articles
-        article_features = self.ArticleTower(article_features)
-        # return product 
-        return torch.sigmoid(torch.matmul(customer_features,article_features.T).diag())
-
 class ArticleTowerEmbedded(nn.Module):
-    '''Article Tower with embedded layers'''
+    '''
+    Article Tower with embedded layers. The embeddings of all categorical columns are stored in one table,
+    the codes of each column are shifted by the offset of its rows so all columns are looked up in a single call.
+    Old state dicts and whole pickled models with one embedding layer per column are converted when loaded.
+    '''
     def __init__(self, article_cat_dim, embedding_dim=3, output_dim=3):
         super(ArticleTowerEmbedded, self).__init__()
-        self.embedding_layers = nn.ModuleList([
-            nn.Embedding(num_categories, embedding_dim)
-            for num_categories in article_cat_dim
-        ])
+        self.embedding = nn.Embedding(sum(article_cat_dim), embedding_dim)
+        # first row of every column in the table
+        self.register_buffer("offsets", torch.tensor(np.cumsum([0] + list(article_cat_dim[:-1])), dtype=torch.int64), persistent=False)
+        # number of rows of every column, codes outside of them would read the rows of the next column
+        self.register_buffer("sizes", torch.tensor(list(article_cat_dim), dtype=torch.int64), persistent=False)
         self.fc1 = nn.Linear(embedding_dim * len(article_cat_dim), output_dim)
+        self.quantized = False
 
     def forward(self, x):
-            # Embedding layers for categorical variables
-            embedded_features = [
-                embedding_layer(x[:,i].T)
-                for i, embedding_layer in enumerate(self.embedding_layers)
-            ]
+        # Embedding layers for categorical variables, concatenated along the last dimension
+        x = x.to(torch.int64)
+        # the check synchronizes with the device, so it is skipped in inference mode
+        if not torch.is_inference_mode_enabled() and ((x < 0) | (x >= self.sizes)).any():
+            raise IndexError("Article code out of range of its embedding column")
+        index = x + self.offsets
+        if self.quantized:
+            embedded_features = self.quantized_weight[index].to(self.weight_scale.dtype) * self.weight_scale[index]
+        else:
+            embedded_features = self.embedding(index)
+        x = embedded_features.flatten(start_dim=1)
+
+        # Fully connected layer
+        x = F.relu(self.fc1(x))
+        return x
+
+    def quantize(self):
+        '''
+        Replaces the embedding table with int8 rows and a float scale per row for inference, which makes the table 4 times smaller.
+        To load a quantized state dict call quantize on the new model first.
+        '''
+        weight = self.embedding.weight.detach()
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / 127
+        self.register_buffer("quantized_weight", torch.round(weight / scale).to(torch.int8))
+        self.register_buffer("weight_scale", scale)
+        del self.embedding
+        self.quantized = True
+        return self
 
-            # Concatenate embedded categorical variables along the last dimension
-            x = torch.cat(embedded_features, dim=-1)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert state dicts with one embedding layer per column (embedding_layers.i.weight) to the single table
+        layers_prefix = prefix + "embedding_layers."
+        layer_keys = sorted((key for key in state_dict if key.startswith(layers_prefix)), key=lambda key: int(key.split(".")[-2]))
+        if layer_keys:
+            state_dict[prefix + "embedding.weight"] = torch.cat([state_dict.pop(key) for key in layer_keys])
+        super(ArticleTowerEmbedded, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-            # Fully connected layer
-            x = F.relu(self.fc1(x))
-            return x
+    def __setstate__(self, state):
+        # convert whole models pickled with one embedding layer per column (torch.save(model)) to the single table
+        super(ArticleTowerEmbedded, self).__setstate__(state)
+        if "embedding_layers" in self._modules:
+            layers = self._modules.pop("embedding_layers")
+            self.embedding = nn.Embedding.from_pretrained(torch.cat([layer.weight.detach() for layer in layers]), freeze=False)
+            sizes = [layer.num_embeddings for layer in layers]
+            device = self.embedding.weight.device
+            self.register_buffer("offsets", torch.tensor(np.cumsum([0] + sizes[:-1]), dtype=torch.int64, device=device), persistent=False)
+            self.register_buffer("sizes", torch.tensor(sizes, dtype=torch.int64, device=device), persistent=False)
+            self.quantized = False
+        elif "sizes" not in self._buffers:
+            # fused models pickled before the sizes were stored, the last column ends at the end of the table
+            n_rows = (self.quantized_weight if self.quantized else self.embedding.weight).shape[0]
+            self.register_buffer("sizes", torch.diff(self.offsets, append=self.offsets.new_tensor([n_rows])), persistent=False)
 
-class TwoTowerEmbedded(nn.Module):
+class TwoTowerEmbedded(TwoTowerScoring):
     '''Two Tower model with embedded Article Tower and shallow Customer Tower'''
-    def __init__(self, article_cat_dim, input_customer_dim, embedding_dim=5, output_dim=3):
+    def __init__(self, article_cat_dim, input_customer_dim, embedding_dim=5, output_dim=3, in_batch_negatives=False):
         super(TwoTowerEmbedded, self).__init__()
+        self.in_batch_negatives = in_batch_negatives
         # Article tower
         self.ArticleTower = ArticleTowerEmbedded(article_cat_dim, embedding_dim, output_dim)
         # Customer tower
         self.CustomerTower = CustomerTower(input_customer_dim, output_dim)
 
-    def forward(self, customer_features, article_features):
-        # customers
-        c_features = self.CustomerTower(customer_features)
-        # articles
-        a_features = self.ArticleTower(article_features)
-        # return product
-        return torch.sigmoid(torch.matmul(c_features, a_features.to(c_features.dtype).T).diag())
-
 class ArticleTowerLog(nn.Module):
     '''Article Tower with deep layers'''
     def __init__(self, input_article_dim, output_dim=3):
@@ -130,33 +233,63 @@ class ArticleTowerLog(nn.Module):
         return x
     
 class LogisticRegression(nn.Module):
-    '''Logistic Regression model with deep Article Tower and seperate list of linear layers for each customer'''
-    def __init__(self, input_article_dim, input_customer_dim, output_dim=3):
+    '''
+    Logistic Regression model with deep Article Tower and seperate linear layer for each customer.
+    Weights and biases of all customers are stored in two embedding tables, so a batch gathers the layers of its customers
+    and applies them with one batched matmul. With sparse=True only the gathered rows receive gradients, which requires
+    an optimizer supporting sparse gradients (e.g. optim.SGD, optim.Adagrad or optim.SparseAdam).
+    The forward pass scores the i-th customer with the i-th article and returns B probabilities for a batch of B pairs,
+    not the B x B matrix of every customer of the batch with every article of the batch.
+    Old state dicts and whole pickled models with customer_linear_layers are converted when loaded.
+    '''
+    def __init__(self, input_article_dim, input_customer_dim, output_dim=3, sparse=False):
         super(LogisticRegression, self).__init__()
 
         # Article tower
         self.ArticleTower = ArticleTowerLog(input_article_dim, output_dim)
 
         # Linear layers for each customer
-        self.customer_linear_layers = nn.ModuleList([
-            nn.Linear(output_dim, 1)  # Assuming input_article_dim is the same for each customer
-            for _ in range(input_customer_dim)
-        ])
+        self.customer_weights = nn.Embedding(input_customer_dim, output_dim, sparse=sparse)
+        self.customer_bias = nn.Embedding(input_customer_dim, 1, sparse=sparse)
+        # same initialization as nn.Linear(output_dim, 1)
+        bound = 1 / np.sqrt(output_dim)
+        nn.init.uniform_(self.customer_weights.weight, -bound, bound)
+        nn.init.uniform_(self.customer_bias.weight, -bound, bound)
 
     def forward(self, customers_id, article_features):
         # Articles
         article_features = self.ArticleTower(article_features)
-        # Individual linear layers for each customer
-        selected_layers = [self.customer_linear_layers[i] for i in customers_id.to(torch.int64)]
+        # Gather the linear layers of the customers
+        customers_id = customers_id.to(torch.int64)
+        weights = self.customer_weights(customers_id)
+        bias = self.customer_bias(customers_id).squeeze(1)
 
-        # Apply all linear layers to article features in a single forward pass
-        customer_logits = torch.cat([layer(article_features) for layer in selected_layers], dim=1)
+        # Apply the linear layer of each customer to its article in a single batched matmul
+        customer_logits = torch.bmm(weights.unsqueeze(1), article_features.unsqueeze(2)).view(-1) + bias
 
         # Apply sigmoid activation to get probabilities
         customer_probabilities = torch.sigmoid(customer_logits)
 
         return customer_probabilities
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert state dicts with a list of linear layers (customer_linear_layers.i.weight) to the embedding tables
+        layers_prefix = prefix + "customer_linear_layers."
+        layer_keys = [key for key in state_dict if key.startswith(layers_prefix)]
+        if layer_keys:
+            n_customers = len(layer_keys) // 2
+            state_dict[prefix + "customer_weights.weight"] = torch.cat([state_dict.pop(f"{layers_prefix}{i}.weight") for i in range(n_customers)])
+            state_dict[prefix + "customer_bias.weight"] = torch.stack([state_dict.pop(f"{layers_prefix}{i}.bias") for i in range(n_customers)])
+        super(LogisticRegression, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __setstate__(self, state):
+        # convert whole models pickled with a list of linear layers (torch.save(model)) to the embedding tables
+        super(LogisticRegression, self).__setstate__(state)
+        if "customer_linear_layers" in self._modules:
+            layers = self._modules.pop("customer_linear_layers")
+            self.customer_weights = nn.Embedding.from_pretrained(torch.cat([layer.weight.detach() for layer in layers]), freeze=False)
+            self.customer_bias = nn.Embedding.from_pretrained(torch.stack([layer.bias.detach() for layer in layers]), freeze=False)
+
 class CustomerTowerFinal(nn.Module):
     '''Customer Tower model with 1 layer'''
     def __init__(self, input_customer_dim, output_dim=10):
@@ -185,22 +318,15 @@ class ArticleTowerFinal(nn.Module):
         x = self.fc4(x)
         return x
 
-class TwoTowerFinal(nn.Module):
+class TwoTowerFinal(TwoTowerScoring):
     '''Two Tower model with shallow Customer Tower and deep Article Tower'''
-    def __init__(self, input_article_dim, input_customer_dim, output_dim=10):
+    def __init__(self, input_article_dim, input_customer_dim, output_dim=10, in_batch_negatives=False):
         super(TwoTowerFinal,self).__init__()
+        self.in_batch_negatives = in_batch_negatives
         # Article tower
         self.ArticleTower = ArticleTowerFinal(input_article_dim, output_dim)
         self.CustomerTower = CustomerTowerFinal(input_customer_dim, output_dim)
 
-    def forward(self, customer_features, article_features):
-        #customers
-        customer_features = self.CustomerTower(customer_features)
-        # articles
-        article_features = self.ArticleTower(article_features)
-        # return product 
-        return torch.sigmoid(torch.matmul(customer_features,article_features.T).diag())
-
 class CustomerTowerDiversification(nn.Module):
     '''Customer Tower model with 3 hidden layers'''
     def __init__(self, input_customer_dim, output_dim=10):
@@ -218,18 +344,11 @@ class CustomerTowerDiversification(nn.Module):
         x = self.fc4(x)
         return x
 
-class TwoTowerCustomer(nn.Module):
+class TwoTowerCustomer(TwoTowerScoring):
     '''Two Tower model with deep Customer Tower and Article Tower'''
-    def __init__(self, input_article_dim, input_customer_dim, output_dim=10):
+    def __init__(self, input_article_dim, input_customer_dim, output_dim=10, in_batch_negatives=False):
         super(TwoTowerCustomer,self).__init__()
+        self.in_batch_negatives = in_batch_negatives
         # Article tower
         self.ArticleTower = ArticleTowerFinal(input_article_dim, output_dim)
         self.CustomerTower = CustomerTowerDiversification(input_customer_dim, output_dim)
-
-    def forward(self, customer_features, article_features):
-        #customers
-        customer_features = self.CustomerTower(customer_features)
-        # articles
-        article_features = self.ArticleTower(article_features)
-        # return product 
-        return torch.sigmoid(torch.matmul(customer_features,article_features.T).diag())
@@ -1,10 +1,314 @@
+import os
+import hashlib
 import torch 
-import torch.nn.functional as nn
+import torch.multiprocessing as mp
+from torch.utils.data import BatchSampler
 from tqdm import tqdm
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, issparse
+from runtime import get_runtime, available_cores
+from ann import candidate_scores
+from storage import interaction_keys, contains_keys
+from metrics import evaluate_recommendations
 
-def recommender_softmax(model, dataloader, restrictions, evaluate:bool=False, top_k=5):
+EMBEDDING_STORE_DIR = "data/preprocessed/embeddings"
+EMBEDDING_STORE_VERSION = 1
+
+def dataset_length(dataloader):
+    '''Number of rows of the dataloader, None if its dataset has no length.'''
+    try:
+        # datasets indexed with whole batches may be sampled only partly (e.g. the validation rows from load_data)
+        if isinstance(dataloader.sampler, BatchSampler):
+            return len(dataloader.sampler.sampler)
+        return len(dataloader.dataset)
+    except (AttributeError, TypeError):
+        return None
+
+def materialize_embeddings(tower, dataloader, runtime, input_dtype=None, out=None, out_dtype=np.float32):
+    '''
+    Pushes all batches of the dataloader through the tower and writes the embeddings into one preallocated tensor,
+    avoiding the quadratic copying of stacking the batches one by one.
+    Args:
+        tower (nn.Module): Customer or Article Tower.
+        dataloader (data.DataLoader): Dataloader with sparse or dense features.
+        runtime (Runtime): Device and dtype used by the tower.
+        input_dtype (torch.dtype, optional): Dtype of the features, e.g. torch.int64 for embedding layers. Defaults to the runtime dtype.
+        out (str, optional): Path of a .npy file, the embeddings are written into a memory-mapped file on cpu instead of device memory.
+        out_dtype (np.dtype, optional): Dtype of the memory-mapped file, float32 or float16. Defaults to float32.
+    Returns:
+        torch.Tensor: Embeddings of all rows of the dataloader.
+    '''
+    n_rows = dataset_length(dataloader)
+    embeddings = None
+    batches = []
+    start = 0
+    with torch.inference_mode():
+        for features in tqdm(dataloader):
+            features = features.to_dense()
+            features = runtime.to(features.to(input_dtype) if input_dtype is not None else features)
+            batch = tower(features)
+            if n_rows is None:
+                batches.append(batch)
+                continue
+            # the dimension of the embeddings is known after the first batch
+            if embeddings is None:
+                if out is not None:
+                    embeddings = torch.from_numpy(np.lib.format.open_memmap(out, mode="w+", dtype=out_dtype, shape=(n_rows, batch.shape[1])))
+                else:
+                    embeddings = torch.empty((n_rows, batch.shape[1]), device=runtime.device, dtype=batch.dtype)
+            embeddings[start:start+batch.shape[0]] = batch.to(embeddings.device, embeddings.dtype)
+            start += batch.shape[0]
+    if n_rows is None:
+        return torch.cat(batches)
+    return embeddings[:start]
+
+def tower_fingerprint(tower):
+    '''Hash of the tower architecture and weights, changes whenever the model is retrained.'''
+    digest = hashlib.sha1(f"{EMBEDDING_STORE_VERSION}-{type(tower).__name__}".encode())
+    for name, tensor in tower.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().to("cpu").contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+def features_fingerprint(dataloader):
+    '''
+    Hash of the features fed into the tower. Matrices of datasets from load_customers_articles are hashed directly,
+    other dataloaders are hashed batch by batch.
+    '''
+    digest = hashlib.sha1()
+    dataset = getattr(dataloader, "dataset", None)
+    features = getattr(dataset, "df", dataset)
+    if issparse(features):
+        features = csr_matrix(features)
+        digest.update(str(features.shape).encode())
+        for array in [features.indptr, features.indices, features.data]:
+            digest.update(np.ascontiguousarray(array).tobytes())
+    elif isinstance(features, (np.ndarray, torch.Tensor)):
+        features = np.ascontiguousarray(features.numpy() if isinstance(features, torch.Tensor) else features)
+        digest.update(f"{features.shape}-{features.dtype}".encode())
+        digest.update(features.tobytes())
+    else:
+        for batch in dataloader:
+            digest.update(np.ascontiguousarray(batch.to_dense().numpy()).tobytes())
+    return digest.hexdigest()
+
+def stored_embeddings(tower, dataloader, runtime, name, store_dir=EMBEDDING_STORE_DIR, input_dtype=None, dtype=np.float32):
+    '''
+    Returns the embeddings of the tower from the embedding store, the tower is run only when the store has no embeddings
+    for this tower weights and features. Embeddings are saved as memory-mapped .npy files and loaded lazily.
+    Args:
+        tower (nn.Module): Customer or Article Tower.
+        dataloader (data.DataLoader): Dataloader with sparse or dense features.
+        runtime (Runtime): Device and dtype used by the tower.
+        name (str): Name of the embeddings, e.g. "customers" or "articles".
+        store_dir (str, optional): Directory of the embedding store.
+        input_dtype (torch.dtype, optional): Dtype of the features, e.g. torch.int64 for embedding layers.
+        dtype (np.dtype, optional): Dtype of the saved embeddings, float32 or float16 to halve the size.
+    Returns:
+        torch.Tensor: Embeddings backed by the memory-mapped file.
+    '''
+    key = f"{name}-{tower_fingerprint(tower)[:16]}-{features_fingerprint(dataloader)[:16]}-{np.dtype(dtype).name}"
+    path = os.path.join(store_dir, key + ".npy")
+    if not os.path.exists(path):
+        os.makedirs(store_dir, exist_ok=True)
+        # written under a temporary name, so an interrupted run does not leave incomplete embeddings in the store
+        tmp_path = os.path.join(store_dir, key + ".tmp.npy")
+        embeddings = materialize_embeddings(tower, dataloader, runtime, input_dtype, out=tmp_path, out_dtype=dtype)
+        if not os.path.exists(tmp_path):
+            # dataloaders without a length are stacked in memory instead of the memory-mapped file
+            np.save(tmp_path, embeddings.to("cpu").numpy().astype(dtype))
+        os.replace(tmp_path, path)
+    else:
+        print(f"Loading {name} embeddings from {path}")
+    return torch.from_numpy(np.load(path, mmap_mode="c"))
+
+def tower_embeddings(tower, dataloader, runtime, name, store_dir=None, input_dtype=None, store_dtype=np.float32):
+    '''Embeddings from the embedding store if store_dir is given, otherwise computed with materialize_embeddings.'''
+    if store_dir is None:
+        return materialize_embeddings(tower, dataloader, runtime, input_dtype)
+    return stored_embeddings(tower, dataloader, runtime, name, store_dir, input_dtype, store_dtype)
+
+def restriction_mask(restrictions, n_articles):
+    '''
+    Boolean mask of the articles allowed by all restrictions, computed once for all customers.
+    Args:
+        restrictions: list of article indices, or list of such lists which all have to hold. Empty for no restriction.
+        n_articles (int): Number of articles.
+    Returns:
+        torch.Tensor: Boolean mask (n_articles,), None if there is no restriction.
+    '''
+    if restrictions is None or len(restrictions) == 0:
+        return None
+    if np.ndim(next(iter(restrictions))) == 0:
+        restrictions = [restrictions]
+    allowed = torch.ones(n_articles, dtype=torch.bool)
+    for restriction in restrictions:
+        mask = torch.zeros(n_articles, dtype=torch.bool)
+        mask[torch.as_tensor(np.asarray(restriction, dtype=np.int64))] = True
+        allowed &= mask
+    return allowed
+
+def block_mask(matrix, start, end, shape, position=None, candidates=None):
+    '''
+    Boolean mask of the scores of customers start:end which are nonzero in the csr matrix, built from the csr indices.
+    Args:
+        matrix (csr_matrix): customers x articles matrix.
+        start, end (int): Rows of the block.
+        shape (tuple): Shape of the block scores.
+        position (torch.Tensor, optional): Column of every article in the scores, -1 for articles that are not scored.
+        candidates (torch.Tensor, optional): Articles of every column of the scores, when scores are computed for ann candidates.
+    Returns:
+        torch.Tensor: Boolean mask of the given shape.
+    '''
+    block = matrix[start:end]
+    block.sort_indices()
+    rows = np.repeat(np.arange(end-start, dtype=np.int64), np.diff(block.indptr))
+    if candidates is None:
+        mask = torch.zeros(shape, dtype=torch.bool)
+        columns = position[torch.from_numpy(block.indices.astype(np.int64))]
+        valid = columns >= 0
+        mask[torch.from_numpy(rows)[valid], columns[valid]] = True
+        return mask
+    # membership of the (customer, candidate) pairs among the sorted keys of the block
+    keys = interaction_keys(rows, block.indices, matrix.shape[1])
+    candidate_keys = interaction_keys(np.repeat(np.arange(end-start), shape[1]), candidates.clamp(min=0).flatten().numpy(), matrix.shape[1])
+    return torch.from_numpy(contains_keys(keys, candidate_keys).reshape(shape))
+
+def top_k_columns(scores, top_k):
+    '''
+    Columns of the top_k scores of every row. Masked scores (-inf) are never returned: if fewer than top_k scores of a row
+    are finite (e.g. after restricting the articles to a small candidate set or excluding bought ones) the rest of the row
+    is padded with -1, like the missing results of ann.py.
+    '''
+    k = min(top_k, scores.shape[1])
+    values, columns = torch.topk(scores, k=k, dim=1)
+    columns = columns.masked_fill(values == -torch.inf, -1)
+    if k < top_k:
+        columns = torch.cat([columns, torch.full((scores.shape[0], top_k-k), -1, dtype=columns.dtype, device=columns.device)], dim=1)
+    return columns
+
+def top_k_articles(customers_embeddings, articles_embeddings, top_k, runtime, restrictions=None, exclude=None, keep=None,
+                   ann_index=None, ann_candidates=100, ann_probe=None, block_size=None, progress=True):
+    '''
+    Top-k articles by inner product of the embeddings for every customer, computed in blocks of customers.
+    Sigmoid is skipped since it does not change the ranking. The restrictions are combined into one mask before scoring
+    and only the allowed articles are scored, exclusions are filled with -inf straight from the csr indices.
+    Args:
+        customers_embeddings (torch.Tensor): Customers embeddings (n_customers, d).
+        articles_embeddings (torch.Tensor): Articles embeddings (n_articles, d).
+        top_k (int): Number of recommendations.
+        runtime (Runtime): Device and dtype used for scoring.
+        restrictions (list, optional): Article indices that can be recommended, or list of such lists. See restriction_mask.
+        exclude (csr_matrix, optional): Customers x articles matrix, nonzero articles are never recommended (e.g. already bought).
+        keep (csr_matrix, optional): Customers x articles matrix, only nonzero articles are recommended (e.g. personal candidates).
+        ann_index (IVFPQIndex, optional): Index from ann.py, only the retrieved candidates are scored.
+        ann_candidates (int, optional): Number of candidates retrieved from the index for every customer.
+        ann_probe (int, optional): Number of clusters searched in the index.
+        block_size (int, optional): Number of customers scored at once, by default it adapts to the free memory of the device.
+        progress (bool, optional): Whether to show a progress bar.
+    Returns:
+        torch.Tensor: Recommendations (n_customers, top_k) on cpu, padded with -1 if fewer than top_k articles can be recommended.
+    '''
+    n_customers, n_articles = customers_embeddings.shape[0], articles_embeddings.shape[0]
+    allowed = restriction_mask(restrictions, n_articles)
+    exclude = csr_matrix(exclude) if exclude is not None else None
+    keep = csr_matrix(keep) if keep is not None else None
+    if ann_index is None:
+        # score only the allowed articles, position maps an article to its column in the scores
+        allowed_ids = torch.arange(n_articles) if allowed is None else torch.nonzero(allowed).squeeze(1)
+        position = torch.full((n_articles,), -1, dtype=torch.int64)
+        position[allowed_ids] = torch.arange(len(allowed_ids))
+        articles = runtime.to(articles_embeddings[allowed_ids.to(articles_embeddings.device)])
+        n_columns = len(allowed_ids)
+    else:
+        allowed_ids, position = None, None
+        articles = articles_embeddings.to("cpu", torch.float32)
+        n_columns = max(ann_candidates, top_k)
+    if block_size is None:
+        # scores and masks of one customer
+        row_bytes = n_columns * (torch.finfo(runtime.dtype).bits // 8 + 2)
+        if ann_index is not None:
+            # search scores all articles of the probed clusters, the candidates are gathered with their embeddings
+            row_bytes = ann_index.search_bytes(ann_probe) + n_columns * (articles.shape[1]*4 + 8 + 4 + 2)
+        block_size = runtime.block_size(row_bytes)
+    recommendations = torch.empty((n_customers, top_k), dtype=torch.int64)
+    with torch.inference_mode():
+        for start in tqdm(range(0, n_customers, block_size), disable=not progress):
+            end = min(start+block_size, n_customers)
+            customers = customers_embeddings[start:end]
+            if ann_index is None:
+                candidates = None
+                scores = runtime.to(customers) @ articles.T
+            else:
+                _, candidates = ann_index.search(customers.to("cpu", torch.float32), n_columns, ann_probe)
+                scores = candidate_scores(customers.to("cpu", torch.float32), articles, candidates)
+                if allowed is not None:
+                    scores.masked_fill_(~allowed[candidates.clamp(min=0)], -torch.inf)
+            # get rid of already bought articles
+            if exclude is not None:
+                scores.masked_fill_(block_mask(exclude, start, end, scores.shape, position, candidates).to(scores.device), -torch.inf)
+            # keep only personal candidates
+            if keep is not None:
+                scores.masked_fill_(~block_mask(keep, start, end, scores.shape, position, candidates).to(scores.device), -torch.inf)
+            columns = top_k_columns(scores, top_k).cpu()
+            found = allowed_ids[columns.clamp(min=0)] if candidates is None else candidates.gather(1, columns.clamp(min=0))
+            recommendations[start:end] = found.masked_fill(columns < 0, -1)
+    return recommendations
+
+# state of the worker processes of top_k_articles_parallel, set by _init_worker
+_worker_state = {}
+
+def _init_worker(customers_embeddings, articles_embeddings, recommendations, num_threads, kwargs):
+    '''Stores the shared tensors in the worker process, the tensors are not copied.'''
+    torch.set_num_threads(num_threads)
+    _worker_state.update(customers=customers_embeddings, articles=articles_embeddings, recommendations=recommendations, kwargs=kwargs)
+
+def _score_shard(shard):
+    '''Scores the customers start:end of the shard and writes their recommendations into the shared output.'''
+    start, end, exclude, keep = shard
+    state = _worker_state
+    state["recommendations"][start:end] = top_k_articles(state["customers"][start:end], state["articles"], runtime=get_runtime("cpu"),
+                                                         exclude=exclude, keep=keep, progress=False, **state["kwargs"])
+    return end - start
+
+def top_k_articles_parallel(customers_embeddings, articles_embeddings, top_k, restrictions=None, exclude=None, keep=None,
+                            ann_index=None, ann_candidates=100, ann_probe=None, block_size=None, num_workers=None,
+                            shards_per_worker=4, start_method="spawn"):
+    '''
+    Parallel version of top_k_articles on cpu. Customers are split into shards which are scored by a pool of processes.
+    Embeddings and the output are shared memory tensors, so workers neither copy the article embeddings nor send back
+    their recommendations, each worker writes its block directly into the preallocated output.
+    Args:
+        customers_embeddings, articles_embeddings, top_k, restrictions, exclude, keep, ann_index, ann_candidates, ann_probe, block_size:
+            See top_k_articles.
+        num_workers (int, optional): Number of processes. Defaults to the number of available cores.
+        shards_per_worker (int, optional): Number of shards per process, more shards balance the load better.
+        start_method (str, optional): Start method of the processes, "fork" starts faster but is unsafe with threads.
+    Returns:
+        torch.Tensor: Recommendations (n_customers, top_k).
+    '''
+    num_workers = num_workers or available_cores()
+    n_customers = customers_embeddings.shape[0]
+    customers_embeddings = customers_embeddings.to("cpu").contiguous().share_memory_()
+    articles_embeddings = articles_embeddings.to("cpu").contiguous().share_memory_()
+    recommendations = torch.empty((n_customers, top_k), dtype=torch.int64).share_memory_()
+    exclude = csr_matrix(exclude) if exclude is not None else None
+    keep = csr_matrix(keep) if keep is not None else None
+    # every worker gets only the rows of its shard of the exclude and keep matrices
+    bounds = np.linspace(0, n_customers, num_workers*shards_per_worker + 1).astype(np.int64)
+    shards = [(start, end, exclude[start:end] if exclude is not None else None, keep[start:end] if keep is not None else None)
+              for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+    kwargs = {"top_k": top_k, "restrictions": restrictions, "ann_index": ann_index, "ann_candidates": ann_candidates,
+              "ann_probe": ann_probe, "block_size": block_size}
+    num_threads = max(1, available_cores() // num_workers)
+    context = mp.get_context(start_method)
+    with context.Pool(num_workers, initializer=_init_worker,
+                      initargs=(customers_embeddings, articles_embeddings, recommendations, num_threads, kwargs)) as pool:
+        for _ in tqdm(pool.imap_unordered(_score_shard, shards), total=len(shards)):
+            pass
+    return recommendations
+
+def recommender_softmax(model, dataloader, restrictions, evaluate:bool=False, top_k=5, device=None):
     '''
     Recommender system which uses MLP models as a base for generating recommendations.
     Args:
@@ -13,53 +317,72 @@ def recommender_softmax(model, dataloader, restrictions, evaluate:bool=False, to
         restrictions (list): List of indices of articles that can be recommended.
         evaluate (bool, optional): Whether to evaluate the model. Defaults to False.
         top_k (int, optional): Number of recommendations to return. Defaults to 5.
+        device (Runtime or str, optional): Device used to generate the embeddings, the default runtime from runtime.py is used if None.
     Returns:
         torch.Tensor: Tensor of recommendations.
         float (optional): Recall.
         float (optional): Precision.
     '''
-    mps_device = torch.device("mps")
+    runtime = get_runtime(device)
     model.eval()
-    recommendations = torch.zeros(size=(0,top_k)).to(mps_device)
-    model = model.to(mps_device)
+    n_rows = dataset_length(dataloader)
+    # dataloaders without a length (iterable datasets) keep the batches and stack them once at the end
+    recommendations = torch.empty(size=(n_rows,top_k), dtype=torch.int64, device=runtime.device) if n_rows is not None else None
+    batches = []
+    model = runtime.to(model)
     correct = 0
     total = 0
+    start = 0
+    allowed = None
 
-    with torch.no_grad():
+    with torch.inference_mode():
         if evaluate:
-            with torch.no_grad():
+            with torch.inference_mode():
                 for inputs, targets in tqdm(dataloader):
-                    inputs = inputs.to_dense().to(mps_device)
-                    targets = targets.to_dense().to(mps_device)
+                    inputs = runtime.to(inputs)
+                    targets = runtime.to(targets.to_dense())
                     # Get predictions
                     outputs = model(inputs)
-                    # Mask for articles that haven't been sold
-                    mask_matrix = torch.zeros((1,outputs.shape[1])).to(mps_device)
-                    mask_matrix[:,restrictions] = 1
-                    results = outputs.multiply(mask_matrix)
+                    # Mask for articles that haven't been sold, computed once for all batches
+                    if allowed is None:
+                        allowed = restriction_mask(restrictions, outputs.shape[1])
+                        allowed = torch.ones(outputs.shape[1], dtype=torch.bool) if allowed is None else allowed
+                        allowed = allowed.to(runtime.device)
+                    results = outputs.masked_fill(~allowed, -torch.inf)
                     # get top recommendations
-                    _, top_k_indices = torch.topk(results, k=top_k, dim=1)
-                    recommendations = torch.vstack([recommendations, top_k_indices])
+                    top_k_indices = top_k_columns(results, top_k)
+                    if recommendations is None:
+                        batches.append(top_k_indices)
+                    else:
+                        recommendations[start:start+top_k_indices.shape[0]] = top_k_indices
+                    start += top_k_indices.shape[0]
                     # get predictions
                     predicted = torch.zeros_like(results)
-                    predicted.scatter_(1, top_k_indices, 1)
+                    # padded recommendations (-1) add nothing
+                    predicted.scatter_add_(1, top_k_indices.clamp(min=0), (top_k_indices >= 0).to(predicted.dtype))
                     correct_recommendations = predicted * targets
                     correct += correct_recommendations.sum().item() 
                     total += targets.sum()
+            if recommendations is None:
+                recommendations = torch.cat(batches)
             recall = correct / total
             precision = correct / (top_k*recommendations.shape[0])
             return recommendations, recall, precision
         else:
             for inputs in tqdm(dataloader):
-                inputs = inputs.to_dense().to(mps_device)
+                inputs = runtime.to(inputs)
                 # Get predictions
                 outputs = model(inputs)
                 # Select top k articles
-                _, top_k_indices = torch.topk(outputs, k=top_k, dim=1)
-                recommendations = torch.vstack([recommendations, top_k_indices])        
-            return recommendations
+                top_k_indices = top_k_columns(outputs, top_k)
+                if recommendations is None:
+                    batches.append(top_k_indices)
+                else:
+                    recommendations[start:start+top_k_indices.shape[0]] = top_k_indices
+                start += top_k_indices.shape[0]
+            return recommendations if recommendations is not None else torch.cat(batches)
 
-def recommender_two_towers(model, dataloader_cust, dataloader_art, targets, restrictions:list, evaluate: bool=False, top_k=5):
+def recommender_two_towers(model, dataloader_cust, dataloader_art, targets, restrictions:list, evaluate: bool=False, top_k=5, device=None):
     '''
     Recommender system which uses basic Two Tower models as a base for generating recommendations. Uses own batches to handle memory.
     General idea which is also applicable in further functions is that firstly for all customers and articles we create the embeddings.
@@ -73,56 +396,28 @@ def recommender_two_towers(model, dataloader_cust, dataloader_art, targets, rest
         restrictions (list): List of indices of articles that can be recommended.
         evaluate (bool, optional): Whether to evaluate the model. Defaults to False.
         top_k (int, optional): Number of recommendations to return. Defaults to 5.
+        device (Runtime or str, optional): Device used to generate the embeddings, the default runtime from runtime.py is used if None.
     '''
-    mps_device = torch.device("mps")
-    model = model.to(mps_device)
+    runtime = get_runtime(device)
+    model = runtime.to(model)
     # Generate customers and articles embeddings
-    full_articles_embeddings = torch.zeros(size=(0,model.ArticleTower.fc2.out_features)).to(mps_device)
-    full_customers_embeddings = torch.zeros(size=(0,model.CustomerTower.fc2.out_features)).to(mps_device)
-    recommendations = torch.zeros((0,top_k))
-    with torch.no_grad():
-        # push customers through customer tower
-        print("Generate Customer Embeddings...")
-        for customers_features in tqdm(dataloader_cust):
-            customers_embeddings = model.CustomerTower(customers_features.to_dense().to(mps_device))
-            full_customers_embeddings = torch.vstack([full_customers_embeddings, customers_embeddings])
-        # push articles through article tower
-        print("Generate Articles Embeddings...")
-        for articles_features in tqdm(dataloader_art):
-            articles_features = model.ArticleTower(articles_features.to_dense().to(mps_device))
-            full_articles_embeddings = torch.vstack([full_articles_embeddings, articles_features])
+    # push customers through customer tower
+    print("Generate Customer Embeddings...")
+    full_customers_embeddings = materialize_embeddings(model.CustomerTower, dataloader_cust, runtime)
+    # push articles through article tower
+    print("Generate Articles Embeddings...")
+    full_articles_embeddings = materialize_embeddings(model.ArticleTower, dataloader_art, runtime)
     # calculate probability of being purchased
     print("Get recommendations...")
-    partitions = int(np.ceil(full_customers_embeddings.shape[0]/1000))
-    full_articles_embeddings = full_articles_embeddings.to("cpu")
-    full_customers_embeddings = full_customers_embeddings.to("cpu")
-    for i in tqdm(range(partitions)):
-        customer = full_customers_embeddings[i*1000:(i+1)*1000]
-        predictions = nn.sigmoid(customer.matmul(full_articles_embeddings.T))
-        # get rid of already bought articles
-        # results = predictions - torch.tensor(targets[i*1000:(i+1)*1000].todense())
-        # apply mask for products that are currently selling
-        for restriction in restrictions:
-            mask_matrix = torch.zeros((1,full_articles_embeddings.shape[0]))
-            mask_matrix[:,restriction] = 1
-            results = predictions.multiply(mask_matrix)
-        _, top_k_indices = torch.topk(results, k=top_k, dim=1)
-        recommendations = torch.vstack([recommendations, top_k_indices])
-        recommendations = recommendations.to(torch.int64)
+    recommendations = top_k_articles(full_customers_embeddings, full_articles_embeddings, top_k, runtime, restrictions)
     if evaluate:
-        predicted = torch.zeros((full_customers_embeddings.shape[0],full_articles_embeddings.shape[0]))
-        predicted.scatter_(1, recommendations, 1)
-        predicted = csr_matrix(predicted)
-        correct_recommendations = predicted.multiply(targets)
-        total_correct = correct_recommendations.sum().item()
-        total  = targets.sum().item()
-        recall = total_correct / total
-        precision = total_correct / (top_k*predicted.shape[0])
-        return recommendations, recall, precision
+        # hits are computed from the csr targets without a dense customers x articles matrix
+        scores = evaluate_recommendations(recommendations, targets, top_k)
+        return recommendations, scores["recall"], scores["precision"]
     else:
         return recommendations
 
-def recommender_two_towers_embedded(model, dataloader_cust, dataloader_art, targets, restrictions, evaluate: bool=False, top_k=5):
+def recommender_two_towers_embedded(model, dataloader_cust, dataloader_art, targets, restrictions, evaluate: bool=False, top_k=5, device=None):
     '''
     Recommender system which uses Two Tower models with embedding layers as a base for generating recommendations. Uses own batches to handle memory.
     Args:
@@ -133,105 +428,60 @@ def recommender_two_towers_embedded(model, dataloader_cust, dataloader_art, targ
         restrictions (list): List of indices of articles that can be recommended.
         evaluate (bool, optional): Whether to evaluate the model. Defaults to False.
         top_k (int, optional): Number of recommendations to return. Defaults to 5.
+        device (Runtime or str, optional): Device used to generate the embeddings, the default runtime from runtime.py is used if None.
     '''
-    model = model
+    runtime = get_runtime(device)
+    model = runtime.to(model)
     # Generate customers and articles embeddings
-    full_articles_embeddings = torch.zeros(size=(0,model.ArticleTower.fc1.out_features))
-    full_customers_embeddings = torch.zeros(size=(0,model.CustomerTower.fc2.out_features))
-    recommendations = torch.zeros((0,top_k))
-    with torch.no_grad():
-        # push customers through customer tower
-        print("Generate Customer Embeddings...")
-        for customers_features in tqdm(dataloader_cust):
-            customers_embeddings = model.CustomerTower(customers_features.to_dense())
-            full_customers_embeddings = torch.vstack([full_customers_embeddings, customers_embeddings])
-        # push articles through article tower
-        print("Generate Articles Embeddings...")
-        for articles_features in tqdm(dataloader_art):
-            articles_features = model.ArticleTower(articles_features.to_dense().to(torch.int64))
-            full_articles_embeddings = torch.vstack([full_articles_embeddings, articles_features])
+    # push customers through customer tower
+    print("Generate Customer Embeddings...")
+    full_customers_embeddings = materialize_embeddings(model.CustomerTower, dataloader_cust, runtime)
+    # push articles through article tower
+    print("Generate Articles Embeddings...")
+    full_articles_embeddings = materialize_embeddings(model.ArticleTower, dataloader_art, runtime, input_dtype=torch.int64)
     # calculate probability of being purchased
     print("Get recommendations...")
-    partitions = int(np.ceil(full_customers_embeddings.shape[0]/1000))
-    full_articles_embeddings = full_articles_embeddings
-    full_customers_embeddings = full_customers_embeddings
-    for i in tqdm(range(partitions)):
-        customer = full_customers_embeddings[i*1000:(i+1)*1000]
-        predictions = nn.sigmoid(customer.matmul(full_articles_embeddings.T))
-        # get rid of already bought articles
-        # results = predictions - torch.tensor(targets[i*1000:(i+1)*1000].todense())
-        # apply mask for products that are currently selling
-        mask_matrix = torch.zeros((1,full_articles_embeddings.shape[0]))
-        mask_matrix[:,restrictions] = 1
-        results = predictions.multiply(mask_matrix)
-        _, top_k_indices = torch.topk(results, k=top_k, dim=1)
-        recommendations = torch.vstack([recommendations, top_k_indices])
-        recommendations = recommendations.to(torch.int64)
+    recommendations = top_k_articles(full_customers_embeddings, full_articles_embeddings, top_k, runtime, restrictions)
     if evaluate:
-        predicted = torch.zeros((full_customers_embeddings.shape[0],full_articles_embeddings.shape[0]))
-        predicted.scatter_(1, recommendations, 1)
-        predicted = csr_matrix(predicted)
-        correct_recommendations = predicted.multiply(targets)
-        total_correct = correct_recommendations.sum().item()
-        total  = targets.sum().item()
-        recall = total_correct / total
-        precision = total_correct / (top_k*predicted.shape[0])
-        return recommendations, recall, precision
+        # hits are computed from the csr targets without a dense customers x articles matrix
+        scores = evaluate_recommendations(recommendations, targets, top_k)
+        return recommendations, scores["recall"], scores["precision"]
     else:
         return recommendations
 
-def recommender_logistic(model, customers_n, dataloader_art, targets, restrictions, evaluate: bool=False, top_k=5):
+def recommender_logistic(model, customers_n, dataloader_art, targets, restrictions, evaluate: bool=False, top_k=5, device=None, batch_size=1024):
     '''
     Recommender system which uses model with linear layers for each customers as a base for generating recommendations. Uses own batches to handle memory.
     Args:
         model (nn.Module): Two Tower models with sparate list of linear layers for each customer.
-        dataloader_cust (data.DataLoader): Dataloader for the customer dataset from data_reader.py.
+        customers_n (int): Number of customers.
         dataloader_art (data.DataLoader): Dataloader for the article dataset from data_reader.py.
         targets (torch.Tensor): Tensor of targets.
         restrictions (list): List of indices of articles that can be recommended.
         evaluate (bool, optional): Whether to evaluate the model. Defaults to False.
         top_k (int, optional): Number of recommendations to return. Defaults to 5.
+        device (Runtime or str, optional): Device used to generate the embeddings, the default runtime from runtime.py is used if None.
+        batch_size (int, optional): Number of customers scored at once. Defaults to 1024.
     '''
-    # Generate customers and articles embeddings
-    full_articles_embeddings = torch.zeros(size=(0,model.ArticleTower.fc4.out_features))
-    recommendations = torch.zeros((0,top_k))
-    with torch.no_grad():
-        # push customers through customer tower
-        # push articles through article tower
-        print("Generate Articles Embeddings...")
-        for articles_features in tqdm(dataloader_art):
-            print()
-            articles_features = model.ArticleTower(articles_features.to_dense())
-            full_articles_embeddings = torch.vstack([full_articles_embeddings, articles_features])
-    # calculate probability of being purchased
+    runtime = get_runtime(device)
+    model = runtime.to(model)
+    # Generate articles embeddings
+    # push articles through article tower
+    print("Generate Articles Embeddings...")
+    full_articles_embeddings = materialize_embeddings(model.ArticleTower, dataloader_art, runtime)
+    # calculate probability of being purchased, the bias of every customer is added through a column of ones
     print("Get recommendations...")
-    full_articles_embeddings = full_articles_embeddings
-
-    for i in tqdm(range(customers_n)):
-        predictions = nn.sigmoid(model.customer_linear_layers[i](full_articles_embeddings))
-        # get rid of already bought articles
-        # results = predictions - torch.tensor(targets[i*1000:(i+1)*1000].todense())
-        # apply mask for products that are currently selling
-        mask_matrix = torch.zeros((1,full_articles_embeddings.shape[0]))
-        mask_matrix[:,restrictions] = 1
-        results = predictions.multiply(mask_matrix)
-        _, top_k_indices = torch.topk(results, k=top_k, dim=1)
-        recommendations = torch.vstack([recommendations, top_k_indices])
-        recommendations = recommendations.to(torch.int64)
+    customers_embeddings = torch.hstack([model.customer_weights.weight[:customers_n], model.customer_bias.weight[:customers_n]]).detach()
+    articles_embeddings = torch.hstack([full_articles_embeddings, torch.ones((full_articles_embeddings.shape[0], 1), device=full_articles_embeddings.device, dtype=full_articles_embeddings.dtype)])
+    recommendations = top_k_articles(customers_embeddings, articles_embeddings, top_k, runtime, restrictions, block_size=batch_size)
     if evaluate:
-        predicted = torch.zeros((customers_n,full_articles_embeddings.shape[0]))
-        predicted.scatter_(1, recommendations, 1)
-        predicted = csr_matrix(predicted)
-        correct_recommendations = predicted.multiply(targets)
-        total_correct = correct_recommendations.sum().item()
-        total  = targets.sum().item()
-        recall = total_correct / total
-        precision = total_correct / (top_k*predicted.shape[0])
-        return recommendations, recall, precision
+        # hits are computed from the csr targets without a dense customers x articles matrix
+        scores = evaluate_recommendations(recommendations, targets, top_k)
+        return recommendations, scores["recall"], scores["precision"]
     else:
         return recommendations
 
-def recommender_two_towers_final(model, dataloader_cust, dataloader_art, targets, restrictions:list, evaluate: bool=False, top_k=5, exclude_already_bought=False, personal_candidates=[]):
+def recommender_two_towers_final(model, dataloader_cust, dataloader_art, targets, restrictions:list, evaluate: bool=False, top_k=5, exclude_already_bought=False, personal_candidates=[], device=None, store_dir=None, store_dtype=np.float32, ann_index=None, ann_candidates=100, ann_probe=None, num_workers=0):
     '''
     Recommender system which uses Two Tower models with linear layers as a base for generating recommendations. Uses own batches to handle memory.
     Args:
@@ -244,57 +494,39 @@ def recommender_two_towers_final(model, dataloader_cust, dataloader_art, targets
         top_k (int, optional): Number of recommendations to return. Defaults to 5.
         exclude_already_bought (bool, optional): Whether to exclude already bought articles. Defaults to False.
         personal_candidates (list, optional): List of personal candidates used for repurchased candidates.
+        device (Runtime or str, optional): Device used to generate the embeddings, the default runtime from runtime.py is used if None.
+        store_dir (str, optional): Directory of the embedding store, embeddings of unchanged towers and features are loaded instead of recomputed.
+        store_dtype (np.dtype, optional): Dtype of the embeddings saved in the store, float32 or float16.
+        ann_index (IVFPQIndex, optional): Index from ann.py built over the article embeddings. If given, only the
+            ann_candidates articles retrieved from the index are scored instead of the whole catalog.
+        ann_candidates (int, optional): Number of candidates retrieved from the index for every customer. Defaults to 100.
+        ann_probe (int, optional): Number of clusters searched in the index, defaults to the n_probe of the index.
+        num_workers (int, optional): Number of processes scoring the customers on cpu, 0 scores them in the current process. Defaults to 0.
     '''
-    mps_device = torch.device("mps")
-    model = model.to(mps_device)
+    runtime = get_runtime(device)
+    model = runtime.to(model)
     # Generate customers and articles embeddings
-    full_articles_embeddings = torch.zeros(size=(0,model.ArticleTower.fc4.out_features)).to(mps_device)
-    full_customers_embeddings = torch.zeros(size=(0,model.CustomerTower.fc1.out_features)).to(mps_device)
-    recommendations = torch.zeros((0,top_k))
-    with torch.no_grad():
-        # push customers through customer tower
-        for customers_features in dataloader_cust:
-            customers_embeddings = model.CustomerTower(customers_features.to_dense().to(mps_device))
-            full_customers_embeddings = torch.vstack([full_customers_embeddings, customers_embeddings])
-        # push articles through article tower
-        for articles_features in dataloader_art:
-            articles_features = model.ArticleTower(articles_features.to_dense().to(mps_device))
-            full_articles_embeddings = torch.vstack([full_articles_embeddings, articles_features])
+    # push customers through customer tower
+    full_customers_embeddings = tower_embeddings(model.CustomerTower, dataloader_cust, runtime, "customers", store_dir, store_dtype=store_dtype)
+    # push articles through article tower
+    full_articles_embeddings = tower_embeddings(model.ArticleTower, dataloader_art, runtime, "articles", store_dir, store_dtype=store_dtype)
     # calculate probability of being purchased
-    partitions = int(np.ceil(full_customers_embeddings.shape[0]/1000))
-    full_articles_embeddings = full_articles_embeddings.to("cpu")
-    full_customers_embeddings = full_customers_embeddings.to("cpu")
-    for i in range(partitions):
-        customer = full_customers_embeddings[i*1000:(i+1)*1000]
-        results = nn.sigmoid(customer.matmul(full_articles_embeddings.T))
-        # get rid of already bought articles
-        if exclude_already_bought:
-            results = results - torch.tensor(targets[i*1000:(i+1)*1000].todense())
-        # apply personal candidates (for repurchased articles)
-        if type(personal_candidates) != list:
-            results = results.multiply(torch.tensor(personal_candidates[i*1000:(i+1)*1000].todense()))
-        # apply mask for products that are currently selling
-        for restriction in restrictions:
-            mask_matrix = torch.zeros((1,full_articles_embeddings.shape[0]))
-            mask_matrix[:,restriction] = 1
-            results = results.multiply(mask_matrix)
-        _, top_k_indices = torch.topk(results, k=top_k, dim=1)
-        recommendations = torch.vstack([recommendations, top_k_indices])
-        recommendations = recommendations.to(torch.int64)
+    exclude = targets if exclude_already_bought else None
+    keep = personal_candidates if type(personal_candidates) != list else None
+    if num_workers > 0:
+        recommendations = top_k_articles_parallel(full_customers_embeddings, full_articles_embeddings, top_k, restrictions, exclude, keep,
+                                                  ann_index, ann_candidates, ann_probe, num_workers=num_workers)
+    else:
+        recommendations = top_k_articles(full_customers_embeddings, full_articles_embeddings, top_k, runtime, restrictions, exclude, keep,
+                                         ann_index, ann_candidates, ann_probe)
     if evaluate:
-        predicted = torch.zeros((full_customers_embeddings.shape[0],full_articles_embeddings.shape[0]))
-        predicted.scatter_(1, recommendations, 1)
-        predicted = csr_matrix(predicted)
-        correct_recommendations = predicted.multiply(targets)
-        total_correct = correct_recommendations.sum().item()
-        total  = targets.sum().item()
-        recall = total_correct / total
-        precision = total_correct / (top_k*predicted.shape[0])
-        return recommendations, recall, precision
+        # hits are computed from the csr targets without a dense customers x articles matrix
+        scores = evaluate_recommendations(recommendations, targets, top_k)
+        return recommendations, scores["recall"], scores["precision"]
     else:
         return recommendations
 
-def recommender_two_towers_customer(model, dataloader_cust, dataloader_art, targets, restrictions:list, evaluate: bool=False, top_k=5, exclude_already_bought=False, personal_candidates=[]):
+def recommender_two_towers_customer(model, dataloader_cust, dataloader_art, targets, restrictions:list, evaluate: bool=False, top_k=5, exclude_already_bought=False, personal_candidates=[], device=None, store_dir=None, store_dtype=np.float32, ann_index=None, ann_candidates=100, ann_probe=None, num_workers=0):
     '''
     Recommender system which uses Two Tower models with linear layers as a base for generating recommendations.
     Args:
@@ -307,52 +539,34 @@ def recommender_two_towers_customer(model, dataloader_cust, dataloader_art, targ
         top_k (int, optional): Number of recommendations to return. Defaults to 5.
         exclude_already_bought (bool, optional): Whether to exclude already bought articles. Defaults to False.
         personal_candidates (list, optional): List of personal candidates used for repurchased candidates.
+        device (Runtime or str, optional): Device used to generate the embeddings, the default runtime from runtime.py is used if None.
+        store_dir (str, optional): Directory of the embedding store, embeddings of unchanged towers and features are loaded instead of recomputed.
+        store_dtype (np.dtype, optional): Dtype of the embeddings saved in the store, float32 or float16.
+        ann_index (IVFPQIndex, optional): Index from ann.py built over the article embeddings. If given, only the
+            ann_candidates articles retrieved from the index are scored instead of the whole catalog.
+        ann_candidates (int, optional): Number of candidates retrieved from the index for every customer. Defaults to 100.
+        ann_probe (int, optional): Number of clusters searched in the index, defaults to the n_probe of the index.
+        num_workers (int, optional): Number of processes scoring the customers on cpu, 0 scores them in the current process. Defaults to 0.
     '''
-    mps_device = torch.device("mps")
-    model = model.to(mps_device)
+    runtime = get_runtime(device)
+    model = runtime.to(model)
     # Generate customers and articles embeddings
-    full_articles_embeddings = torch.zeros(size=(0,model.ArticleTower.fc4.out_features)).to(mps_device)
-    full_customers_embeddings = torch.zeros(size=(0,model.CustomerTower.fc4.out_features)).to(mps_device)
-    recommendations = torch.zeros((0,top_k))
-    with torch.no_grad():
-        # push customers through customer tower
-        for customers_features in dataloader_cust:
-            customers_embeddings = model.CustomerTower(customers_features.to_dense().to(mps_device))
-            full_customers_embeddings = torch.vstack([full_customers_embeddings, customers_embeddings])
-        # push articles through article tower
-        for articles_features in dataloader_art:
-            articles_features = model.ArticleTower(articles_features.to_dense().to(mps_device))
-            full_articles_embeddings = torch.vstack([full_articles_embeddings, articles_features])
+    # push customers through customer tower
+    full_customers_embeddings = tower_embeddings(model.CustomerTower, dataloader_cust, runtime, "customers", store_dir, store_dtype=store_dtype)
+    # push articles through article tower
+    full_articles_embeddings = tower_embeddings(model.ArticleTower, dataloader_art, runtime, "articles", store_dir, store_dtype=store_dtype)
     # calculate probability of being purchased
-    partitions = int(np.ceil(full_customers_embeddings.shape[0]/1000))
-    full_articles_embeddings = full_articles_embeddings.to("cpu")
-    full_customers_embeddings = full_customers_embeddings.to("cpu")
-    for i in range(partitions):
-        customer = full_customers_embeddings[i*1000:(i+1)*1000]
-        results = nn.sigmoid(customer.matmul(full_articles_embeddings.T))
-        # get rid of already bought articles
-        if exclude_already_bought:
-            results = results - torch.tensor(targets[i*1000:(i+1)*1000].todense())
-        # apply personal candidates (for repurchased articles)
-        if type(personal_candidates) != list:
-            results = results.multiply(torch.tensor(personal_candidates[i*1000:(i+1)*1000].todense()))
-        # apply mask for products that are currently selling
-        for restriction in restrictions:
-            mask_matrix = torch.zeros((1,full_articles_embeddings.shape[0]))
-            mask_matrix[:,restriction] = 1
-            results = results.multiply(mask_matrix)
-        _, top_k_indices = torch.topk(results, k=top_k, dim=1)
-        recommendations = torch.vstack([recommendations, top_k_indices])
-        recommendations = recommendations.to(torch.int64)
+    exclude = targets if exclude_already_bought else None
+    keep = personal_candidates if type(personal_candidates) != list else None
+    if num_workers > 0:
+        recommendations = top_k_articles_parallel(full_customers_embeddings, full_articles_embeddings, top_k, restrictions, exclude, keep,
+                                                  ann_index, ann_candidates, ann_probe, num_workers=num_workers)
+    else:
+        recommendations = top_k_articles(full_customers_embeddings, full_articles_embeddings, top_k, runtime, restrictions, exclude, keep,
+                                         ann_index, ann_candidates, ann_probe)
     if evaluate:
-        predicted = torch.zeros((full_customers_embeddings.shape[0],full_articles_embeddings.shape[0]))
-        predicted.scatter_(1, recommendations, 1)
-        predicted = csr_matrix(predicted)
-        correct_recommendations = predicted.multiply(targets)
-        total_correct = correct_recommendations.sum().item()
-        total  = targets.sum().item()
-        recall = total_correct / total
-        precision = total_correct / (top_k*predicted.shape[0])
-        return recommendations, recall, precision
+        # hits are computed from the csr targets without a dense customers x articles matrix
+        scores = evaluate_recommendations(recommendations, targets, top_k)
+        return recommendations, scores["recall"], scores["precision"]
     else:
         return recommendations
\ No newline at end of file
@@ -0,0 +1,109 @@
+import os
+import torch
+
+class Runtime:
+    '''
+    Device and dtype used by the training functions from helper.py and the recommender systems from recommenders.py.
+    Floating point inputs and models are cast to dtype, integer inputs (ids, categorical codes) keep their type.
+    '''
+    def __init__(self, device=None, dtype=torch.float32):
+        self.device = detect_device() if device is None else torch.device(device)
+        self.dtype = dtype
+        # asynchronous copies are only possible from pinned memory to cuda
+        self.pin_memory = self.device.type == "cuda"
+
+    def to(self, x):
+        '''Moves the tensor or model to the device and casts floating point values to dtype.'''
+        if isinstance(x, torch.nn.Module) or x.is_floating_point():
+            return x.to(self.device, self.dtype, non_blocking=self.pin_memory)
+        return x.to(self.device, non_blocking=self.pin_memory)
+
+    def block_size(self, row_bytes, fraction=0.25, max_rows=65536):
+        '''
+        Number of rows of a block that fits into a fraction of the free memory of the device.
+        Args:
+            row_bytes: memory needed by one row of the block (e.g. one customer scored against all articles)
+            fraction: share of the free memory used by one block
+            max_rows: upper limit of the block size
+        Returns:
+            int
+        '''
+        return int(max(1, min(max_rows, fraction * available_memory(self.device) // max(row_bytes, 1))))
+
+    def __repr__(self):
+        return f"Runtime(device={self.device}, dtype={self.dtype}, threads={torch.get_num_threads()})"
+
+_default_runtime = None
+
+def detect_device():
+    '''Returns the best available device: cuda, mps or cpu.'''
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+    return torch.device("cpu")
+
+def available_cores():
+    '''Number of cores the process is allowed to run on.'''
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+def available_memory(device):
+    '''Free memory of the device in bytes, cuda reports the free device memory, mps and cpu the free system memory.'''
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    if hasattr(os, "sysconf") and "SC_AVPHYS_PAGES" in os.sysconf_names:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    # unknown, assume 2GB
+    return 2**31
+
+def configure_runtime(device=None, dtype=torch.float32, num_threads=None, num_interop_threads=None, cores=None):
+    '''
+    Configures the default runtime used when functions are called without a device.
+    Args:
+        device: device name or torch.device, autodetected if None
+        dtype: floating point dtype of models and inputs
+        num_threads: number of threads used by intra-op parallelism (matmuls), defaults to the number of available cores
+        num_interop_threads: number of threads running independent operations, can only be set before any parallel work
+        cores: list of cpu cores the process is pinned to (Linux only), which keeps threads from migrating between cores
+    Returns:
+        Runtime
+    '''
+    global _default_runtime
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads or available_cores())
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            print("Interop threads can only be set before any parallel work has started, keeping", torch.get_num_interop_threads())
+    _default_runtime = Runtime(device, dtype)
+    if _default_runtime.device.type == "cpu":
+        # denormal numbers are extremely slow on cpu and irrelevant for recommendations
+        torch.set_flush_denormal(True)
+    return _default_runtime
+
+def get_runtime(device=None):
+    '''
+    Resolves the device argument of the training and recommender functions.
+    A device name only overrides the device, the dtype set with configure_runtime is kept.
+    Args:
+        device: Runtime, device name, torch.device or None for the default runtime
+    Returns:
+        Runtime
+    '''
+    global _default_runtime
+    if isinstance(device, Runtime):
+        return device
+    if device is not None:
+        if _default_runtime is None:
+            return Runtime(device)
+        if _default_runtime.device == torch.device(device):
+            return _default_runtime
+        return Runtime(device, _default_runtime.dtype)
+    if _default_runtime is None:
+        _default_runtime = Runtime()
+    return _default_runtime
@@ -0,0 +1,158 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import torch
+from typing import Union
+from scipy.sparse import csr_matrix
+
+# Data structures shared by data_reader.py, the training in helper.py and the evaluation.
+# The module has no import side effects (data_reader.py changes the working directory to the data of the project),
+# so it can be imported on any machine and by spawned worker processes.
+
+#######################################################################################
+#                                   Interaction Keys                                  #
+#######################################################################################
+
+def interaction_keys(customer_ids, article_ids, n_articles):
+    '''Encodes (customer, article) pairs as int64 keys customer_id*n_articles+article_id.'''
+    return np.asarray(customer_ids, dtype=np.int64)*n_articles + np.asarray(article_ids, dtype=np.int64)
+
+def csr_interaction_keys(matrix):
+    '''
+    Returns sorted int64 keys of the nonzero (customer, article) pairs of the matrix from matrix_representation.
+    Keys are read from the csr structure directly, so no sorting of the pairs is needed.
+    '''
+    matrix = csr_matrix(matrix)
+    matrix.sort_indices()
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+    return interaction_keys(rows, matrix.indices, matrix.shape[1])
+
+def contains_keys(sorted_keys, keys):
+    '''
+    Vectorized membership test using binary search.
+    Args:
+        sorted_keys: sorted np.array of keys
+        keys: np.array of keys to be tested
+    Returns:
+        boolean np.array indicating which keys are part of sorted_keys
+    '''
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    positions = np.searchsorted(sorted_keys, keys)
+    return sorted_keys[np.minimum(positions, len(sorted_keys)-1)] == keys
+
+#######################################################################################
+#                                     Feature Store                                   #
+#######################################################################################
+
+class FeatureStore:
+    '''
+    Holds customers or articles features as a contiguous torch tensor and gathers the rows of a batch with index_select.
+    The matrix is densified once when it fits into max_dense_bytes, larger matrices stay in csr format 
+    and their rows are scattered directly into a dense batch.
+    '''
+    def __init__(self, features:Union[np.ndarray, csr_matrix, torch.Tensor], dtype:torch.dtype=torch.float32, 
+                 max_dense_bytes:int=2**31, pin_memory:bool=False):
+        self.dtype = dtype
+        self.shape = tuple(features.shape)
+        # pinned batches can be copied to the GPU asynchronously
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        dense_bytes = self.shape[0]*self.shape[1]*torch.empty((), dtype=dtype).element_size()
+        if isinstance(features, torch.Tensor):
+            self.features = features.to(dtype).contiguous()
+            self.sparse = None
+        elif isinstance(features, np.ndarray) or dense_bytes <= max_dense_bytes:
+            features = features if isinstance(features, np.ndarray) else features.toarray()
+            self.features = torch.from_numpy(np.ascontiguousarray(features)).to(dtype)
+            self.sparse = None
+        else:
+            self.features = None
+            self.sparse = csr_matrix(features)
+
+    def __getitem__(self, index:Union[torch.Tensor, np.ndarray, list]):
+        index = torch.as_tensor(index)
+        if self.sparse is None:
+            out = torch.empty((len(index), self.shape[1]), dtype=self.dtype, pin_memory=self.pin_memory)
+            return torch.index_select(self.features, 0, index.to(self.features.device), out=out)
+        # scatter the csr rows into a dense batch
+        index = index.numpy()
+        starts = self.sparse.indptr[index]
+        lengths = self.sparse.indptr[index+1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        batch = torch.zeros((len(index), self.shape[1]), dtype=self.dtype, pin_memory=self.pin_memory)
+        batch[np.repeat(np.arange(len(index)), lengths), self.sparse.indices[positions]] = torch.from_numpy(self.sparse.data[positions]).to(self.dtype)
+        return batch
+
+    def __len__(self):
+        return self.shape[0]
+
+#######################################################################################
+#                                   Columnar Tables                                   #
+#######################################################################################
+
+def downcast_column(column):
+    '''
+    Downcasts a numeric column to the compact dtypes used by the cache (int32, float32, datetime64).
+    Only 64 bit columns are narrowed, columns which are already smaller (e.g. int8 sales_channel_id) keep their dtype.
+    Args:
+        column: pandas series
+    Returns:
+        numpy array
+    '''
+    values = column.to_numpy()
+    if np.issubdtype(values.dtype, np.integer):
+        if values.dtype.itemsize > 4 and (values.size == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max)):
+            return values.astype(np.int32)
+        return values
+    if np.issubdtype(values.dtype, np.floating):
+        return values.astype(np.float32) if values.dtype.itemsize > 4 else values
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[ns]")
+    return values
+
+def _save_table(table, table_dir):
+    '''Saves each column of the dataframe as a separate .npy file. Returns the column dtypes.'''
+    os.makedirs(table_dir, exist_ok=True)
+    dtypes = {}
+    for column in table.columns:
+        values = downcast_column(table[column])
+        np.save(os.path.join(table_dir, f"{column}.npy"), values, allow_pickle=values.dtype == object)
+        dtypes[column] = str(values.dtype)
+    return dtypes
+
+def _load_table(table_dir, columns, mmap=True):
+    '''Loads the columns saved by _save_table. Numeric columns are memory mapped and wrapped without copying.'''
+    data = {}
+    for column, dtype in columns.items():
+        path = os.path.join(table_dir, f"{column}.npy")
+        if dtype == "object":
+            data[column] = np.load(path, allow_pickle=True)
+        else:
+            # copy-on-write mapping, so in-place pandas operations never touch the file
+            data[column] = np.load(path, mmap_mode="c" if mmap else None)
+    return pd.DataFrame(data, columns=list(columns), copy=False)
+
+def save_columns(table, table_dir):
+    '''
+    Saves the dataframe as a directory of typed .npy columns, e.g. the negative samples from create_random_candidates.
+    Args:
+        table: dataframe
+        table_dir: directory to save the columns
+    '''
+    dtypes = _save_table(table, table_dir)
+    with open(os.path.join(table_dir, "columns.json"), "w") as f:
+        json.dump(dtypes, f, indent=2)
+
+def load_columns(table_dir, mmap=True):
+    '''
+    Loads the dataframe saved by save_columns.
+    Args:
+        table_dir: directory with the columns
+        mmap: boolean indicating whether to memory map the columns or read them into memory
+    Returns:
+        dataframe
+    '''
+    with open(os.path.join(table_dir, "columns.json")) as f:
+        dtypes = json.load(f)
+    return _load_table(table_dir, dtypes, mmap)